@@ -22,8 +22,7 @@ from gbd_core.api import GBD, GBDException
 from gbd_core.grammar import ParserException
 from gbd_core import util, contexts, schema
 from gbd_core.util_argparse import *
-from gbd_init.feature_extractors import generic_extractors
-from gbd_init.instance_transformers import generic_transformers
+from gbd_init import catalog
 
 
 ### Command-Line Interface Entry Points
@@ -32,28 +31,48 @@ def cli_hash(api: GBD, args):
     print(identify(args.path))
 
 
+def cli_verify(api: GBD, args):
+    from gbd_init.feature_extractors import verify_local
+    context = api.database.dcontext(args.target)
+    df = api.query(args.query, args.hashes, [ context + ":local" ], collapse=None)
+    failed = 0
+    for (hash, local, found) in verify_local(df, context, args.full):
+        failed = failed + 1
+        if found is None:
+            print("{} {}: file not found".format(hash, local))
+        else:
+            print("{} {}: file has hash {}".format(hash, local, found))
+    util.eprint("{} of {} files failed verification".format(failed, len(df.index)))
+    if failed:
+        sys.exit(1)
+
+
+def resource_limits(args):
+    return { 'jobs': args.jobs, 'tlim': args.tlim, 'mlim': args.mlim, 'flim': args.flim, 'tasks': args.worker_tasks }
+
+
 def cli_init_local(api: GBD, args):
     from gbd_init.feature_extractors import init_local
-    rlimits = { 'jobs': args.jobs, 'tlim': args.tlim, 'mlim': args.mlim, 'flim': args.flim }
+    rlimits = resource_limits(args)
     init_local(api, rlimits, args.path, args.target)
 
 
 def cli_init_generic(api: GBD, args):
     from gbd_init.feature_extractors import init_features_generic
-    rlimits = { 'jobs': args.jobs, 'tlim': args.tlim, 'mlim': args.mlim, 'flim': args.flim }
+    rlimits = resource_limits(args)
     context = api.database.dcontext(args.target)
     df = api.query(args.query, args.hashes, [ context + ":local" ], collapse="MIN", group_by=context + ":hash")
-    init_features_generic(args.initfuncname, api, rlimits, df, args.target)
+    init_features_generic(args.initfuncname, api, rlimits, df, args.target, args.incremental, args.retry_failed)
 
 
 def cli_trans_generic(api: GBD, args):
     from gbd_init.instance_transformers import transform_instances_generic
-    rlimits = { 'jobs': args.jobs, 'tlim': args.tlim, 'mlim': args.mlim, 'flim': args.flim }
+    rlimits = resource_limits(args)
     transform_instances_generic(args.transfuncname, api, rlimits, args.query, args.hashes, args.target, args.source)
 
 
 def cli_create(api: GBD, args):
-    api.create_feature(args.name, args.unique, args.target)
+    api.create_feature(args.name, args.unique, args.target, args.index, args.type)
 
 def cli_delete(api: GBD, args):
     if (args.hashes and len(args.hashes) or args.values and len(args.values)) and args.name:
@@ -76,13 +95,59 @@ def cli_rename(api: GBD, args):
 def cli_copy(api: GBD, args):
     api.copy_feature(args.old_name, args.new_name, args.target, args.query, args.hashes)
 
+def cli_move(api: GBD, args):
+    if args.force or util.confirm("Move feature '{}' to database '{}'?".format(args.name, args.target)):
+        api.move_feature(args.name, args.target, args.source)
+
+
+def cli_maintenance_checkpoint(api: GBD, args):
+    for (dbname, busy, log, checkpointed) in api.checkpoint(args.names, args.mode):
+        if busy:
+            util.eprint("{}: checkpoint incomplete, database is busy ({} of {} frames checkpointed)".format(dbname, checkpointed, log))
+        else:
+            print("{}: {} of {} frames checkpointed".format(dbname, checkpointed, log))
+
+def cli_index(api: GBD, args):
+    if args.action == 'create':
+        api.create_indexes(args.names, args.target)
+    elif args.action == 'drop':
+        if args.force or util.confirm("Drop indexes of {}?".format(" ".join(args.names) if args.names else "all features")):
+            api.drop_indexes(args.names, args.target)
+    for (index, feature) in api.get_indexes(args.target):
+        print("{}: {}".format(feature, index))
+
 
 def cli_get(api: GBD, args):
-    df = api.query(args.query, args.hashes, args.resolve, args.collapse, args.group_by, args.join_type)
-    if args.header:
-        print(args.delimiter.join(df.columns))
-    for index, row in df.iterrows():
-        print(args.delimiter.join([ item or "[None]" for item in row.to_list() ]))
+    from gbd_core import export
+    from gbd_core.api import QueryProfile
+    if args.explain:
+        sql, plan = api.explain(args.query, args.hashes, args.resolve, args.collapse, args.group_by, args.join_type)
+        print(sql)
+        print("\n".join(plan))
+        return
+    profile = QueryProfile() if args.profile else None
+    sql, cols = api.build_query(args.query, args.hashes, args.resolve, args.collapse, args.group_by, args.join_type, profile)
+    # typed formats use declared feature types, types of other columns are inferred from the first chunk of results
+    typed = args.format in [ "jsonl", "arrow", "parquet" ]
+    declared = api.declared_types(args.resolve, args.group_by, args.collapse) if typed else [ "text" for _ in cols ]
+    if args.format in export.BINARY_FORMATS and args.output is None and sys.stdout.isatty():
+        raise GBDException("Refusing to write binary format '{}' to terminal, use --output".format(args.format))
+    if profile is not None:
+        # profiled queries are run through the DataFrame api such that all phases are covered
+        (parse, generate) = (profile.parse, profile.generate)
+        df = api.query(args.query, args.hashes, args.resolve, args.collapse, args.group_by, args.join_type, profile=profile)
+        (profile.parse, profile.generate) = (parse, generate)
+        rows = list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+        types, chunks = export.typed_chunks([ rows ], cols, declared)
+        export.write(chunks, cols, types, args.format, args.output, args.delimiter, args.header)
+        util.eprint(profile.report())
+        return
+    stream = api.stream(sql, cols, args.chunk_size)
+    try:
+        types, chunks = export.typed_chunks(stream, cols, declared)
+        export.write(chunks, cols, types, args.format, args.output, args.delimiter, args.header)
+    finally:
+        stream.close()  # release the cursor before the databases are closed
 
 def cli_set(api: GBD, args):
     hashes = api.query(args.query, args.hashes)['hash'].tolist()
@@ -111,8 +176,11 @@ def cli_info(api: GBD, args):
                 print(" - Features: " + " ".join(feat))
                 if args.verbose:
                     for f in feat:
-                        info = api.database.find(":".join([ dbname, f ]))
-                        print(info)
+                        info = api.get_feature_info(f, dbname, top=5)
+                        print("   - {}: type {}, default {}, {} values ({} distinct){}{}".format(f, info['feature_type'], info['feature_default'],
+                            info['feature_count'], info['feature_distinct'],
+                            ", range [{}, {}]".format(info['feature_min'], info['feature_max']) if info['feature_min'] is not None else "",
+                            ", frequent: {}".format(info['feature_values']) if info['feature_values'] else ""))
     else:
         info = api.get_feature_info(args.name)
         for key in info:
@@ -148,10 +216,12 @@ def main():
     parser_init_local.set_defaults(func=cli_init_local)
 
     # hooks for generic feature extractors:
-    for key in generic_extractors.keys():
-        gex = generic_extractors[key]
+    for key in catalog.extractors.keys():
+        gex = catalog.extractors[key]
         parser_init_generic = parser_init_subparsers.add_parser(key, help=gex["description"])
         add_query_and_hashes_arguments(parser_init_generic)
+        parser_init_generic.add_argument('--incremental', action='store_true', help='Skip instances which already have all features or which were processed by a previous run (resume)')
+        parser_init_generic.add_argument('--retry-failed', action='store_true', help='Only process instances which exceeded the time or memory limit in a previous run')
         parser_init_generic.set_defaults(func=cli_init_generic, initfuncname=key)
 
     # TRANSFORMATION
@@ -163,8 +233,8 @@ def main():
     parser_trans_subparsers = parser_trans.add_subparsers(help='Select Transformation Procedure:', required=True, dest='transform how?')
 
     # hooks for generic instance transformers:
-    for key in generic_transformers.keys():
-        gex = generic_transformers[key]
+    for key in catalog.transformers.keys():
+        gex = catalog.transformers[key]
         parser_trans_generic = parser_trans_subparsers.add_parser(key, help=gex["description"])
         add_query_and_hashes_arguments(parser_trans_generic)
         parser_trans_generic.set_defaults(func=cli_trans_generic, transfuncname=key)
@@ -172,7 +242,14 @@ def main():
     # GBD HASH
     parser_hash = subparsers.add_parser('hash', help='Print hash for a single file')
     parser_hash.add_argument('path', type=file_type, help="Path to one benchmark")
-    parser_hash.set_defaults(func=cli_hash)
+    parser_hash.set_defaults(func=cli_hash, databases=False)
+
+    # GBD VERIFY $QUERY
+    parser_verify = subparsers.add_parser('verify', help='Verify that local benchmark files match their hashes')
+    add_query_and_hashes_arguments(parser_verify)
+    parser_verify.add_argument('--target', help='Database with local paths; determines context (default: first db in list)', default=None)
+    parser_verify.add_argument('--full', action='store_true', help='Hash all files again instead of trusting the hash cache for unmodified files')
+    parser_verify.set_defaults(func=cli_verify)
 
     # GBD GET $QUERY
     parser_get = subparsers.add_parser('get', help='Get data by query (or hash-list via stdin)')
@@ -185,6 +262,12 @@ def main():
     parser_get.add_argument('--join-type', help='Join Type: treatment of missing values', choices=['INNER', 'OUTER', 'LEFT'], default="LEFT")
     parser_get.add_argument('-d', '--delimiter', default=' ', help='CSV delimiter to use in output')
     parser_get.add_argument('-H', '--header', action='store_true', help='Include header information in output')
+    parser_get.add_argument('--chunk-size', type=int, default=10000, help='Number of rows fetched from the database at once')
+    parser_get.add_argument('-f', '--format', default='text', choices=['text', 'csv', 'jsonl', 'arrow', 'parquet'],
+                            help='Output format (arrow and parquet require pyarrow)')
+    parser_get.add_argument('-o', '--output', default=None, help='Output file (default: stdout)')
+    parser_get.add_argument('--explain', action='store_true', help='Print generated SQL and its query plan instead of the result')
+    parser_get.add_argument('--profile', action='store_true', help='Print timings of the query phases to stderr')
     parser_get.set_defaults(func=cli_get)
 
     # GBD SET
@@ -199,6 +282,8 @@ def main():
     parser_create.add_argument('name', type=column_type, help='Name of feature')
     parser_create.add_argument('-u', '--unique', help='Unique constraint: specify default-value of feature')
     parser_create.add_argument('--target', help='Target database (default: first in list)', default=None)
+    parser_create.add_argument('-i', '--index', action='store_true', help='Create index for lookups by feature value')
+    parser_create.add_argument('-t', '--type', default='text', choices=['text', 'int', 'real', 'category'], help='Declared type of feature values')
     parser_create.set_defaults(func=cli_create)
 
     parser_delete = subparsers.add_parser('delete', help='Delete all values assiociated with given hashes (via argument or stdin) or remove feature if no hashes are given')
@@ -226,6 +311,31 @@ def main():
     parser_copy.add_argument('new_name', type=column_type, help='New name of feature')
     parser_copy.set_defaults(func=cli_copy)
 
+    # MOVE FEATURE
+    parser_move = subparsers.add_parser('move', help='Move feature to another database')
+    parser_move.add_argument('name', type=column_type, help='Name of feature')
+    parser_move.add_argument('--source', help='Source database (default: first database containing the feature)', default=None)
+    parser_move.add_argument('--target', help='Target database', required=True)
+    parser_move.add_argument('-f', '--force', action='store_true', help='Do not ask for confirmation')
+    parser_move.set_defaults(func=cli_move)
+
+    # INDEXES
+    parser_index = subparsers.add_parser('index', help='Create, drop or list indexes of features')
+    parser_index.add_argument('action', choices=['create', 'drop', 'list'], help='Index operation (create and drop print remaining indexes)')
+    parser_index.add_argument('names', type=column_type, help='Names of features (default: all)', nargs='*')
+    parser_index.add_argument('--target', help='Target database (default: first in list)', default=None)
+    parser_index.add_argument('-f', '--force', action='store_true', help='Do not ask for confirmation')
+    parser_index.set_defaults(func=cli_index)
+
+    # MAINTENANCE
+    parser_maintenance = subparsers.add_parser('maintenance', help='Database maintenance')
+    parser_maintenance_subparsers = parser_maintenance.add_subparsers(help='Select Maintenance Task:', required=True, dest='maintenance task')
+    parser_checkpoint = parser_maintenance_subparsers.add_parser('checkpoint', help='Transfer write-ahead logs of databases in WAL mode into the database files')
+    parser_checkpoint.add_argument('names', help='Names of databases (default: all)', nargs='*')
+    parser_checkpoint.add_argument('--mode', choices=['passive', 'full', 'restart', 'truncate'], default='truncate', 
+                                   help='Checkpoint mode: passive does not wait for readers and writers, truncate also resets the log file (default)')
+    parser_checkpoint.set_defaults(func=cli_maintenance_checkpoint)
+
     # GET META INFO
     parser_info = subparsers.add_parser('info', help='Print info about available features')
     parser_info.add_argument('-c', '--contexts', action='store_true', help='Print available contexts')
@@ -244,13 +354,25 @@ def main():
         if hasattr(args, 'hashes') and not sys.stdin.isatty():
             if not args.hashes or len(args.hashes) == 0:
                 args.hashes = util.read_hashes()  # read hashes from stdin
+        if not getattr(args, 'databases', True) or getattr(args, 'contexts', False):
+            args.func(None, args)  # fast path: no databases needed
+            return
         if hasattr(args, 'target') and args.target is None:
             args.target = schema.Schema.dbname_from_path(args.db.split(os.pathsep)[0])
         if args.db is None or len(args.db) == 0:
             util.eprint("No database specified. Use -d or set GBD_DB environment variable.")
             sys.exit(1)
-        with GBD(args.db.split(os.pathsep), args.verbose) as api:
+        cache = None
+        if os.environ.get('GBD_QUERY_CACHE'):
+            from gbd_core.cache import DiskCache
+            cache = DiskCache(os.environ.get('GBD_QUERY_CACHE'))
+        with GBD(args.db.split(os.pathsep), args.verbose, cache, args.journal, args.busy_timeout, args.autocheckpoint) as api:
             args.func(api, args)
+    except BrokenPipeError:
+        # output is streamed, the consumer may stop reading early (e.g. gbd get | head)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
     except ModuleNotFoundError as e:
         util.eprint("Module '{}' not found. Please install it.".format(e.name))
         if e.name == 'gbdc':
@@ -15,14 +15,15 @@
 
 
 import sqlite3
-import tatsu
-import pandas as pd
+import time
 
 from contextlib import ExitStack
+from dataclasses import dataclass
 import traceback
 
 from gbd_core.query import GBDQuery
-from gbd_core.database import Database
+from gbd_core.grammar import Parser, ParserException
+from gbd_core.database import Database, DatabaseException
 from gbd_core.database import Schema
 from gbd_core import util
 
@@ -31,12 +32,40 @@ class GBDException(Exception):
     pass
 
 
+@dataclass
+class QueryProfile:
+    """ Timings (in seconds) of the phases of a query, see GBD.query() """
+    schema: float = 0.0
+    parse: float = 0.0
+    generate: float = 0.0
+    execute: float = 0.0
+    fetch: float = 0.0
+    frame: float = 0.0
+    rows: int = 0
+    cached: bool = False
+    sql: str = None
+
+    def total(self):
+        return self.schema + self.parse + self.generate + self.execute + self.fetch + self.frame
+
+    def report(self):
+        phases = [ ("schema loading", self.schema), ("parsing", self.parse), ("sql generation", self.generate),
+                   ("sql execution", self.execute), ("fetching", self.fetch), ("dataframe building", self.frame), ("total", self.total()) ]
+        lines = [ "{:20} {:10.2f} ms".format(name, 1000 * seconds) for (name, seconds) in phases ]
+        return "\n".join(lines + [ "{:20} {:10}{}".format("rows", self.rows, " (cached)" if self.cached else "") ])
+
+
 class GBD:
     # Create a new GBD object which operates on the given databases
-    def __init__(self, dbs: list, verbose: bool=False):
+    # Query results are cached if a cache object is given (see gbd_core.cache.LRUCache and gbd_core.cache.DiskCache)
+    # Journaling profile, busy timeout and checkpoint interval are passed to the database layer (see Database)
+    def __init__(self, dbs: list, verbose: bool=False, cache=None, journal="default", busy_timeout=10, autocheckpoint=None):
         assert(isinstance(dbs, list))
-        self.database = Database(dbs, verbose)
+        start = time.perf_counter()
+        self.database = Database(dbs, verbose, journal=journal, busy_timeout=busy_timeout, autocheckpoint=autocheckpoint)
+        self.load_time = time.perf_counter() - start
         self.verbose = verbose
+        self.cache = cache
 
     def __enter__(self):
         with ExitStack() as stack:
@@ -62,7 +91,34 @@ class GBD:
         return identify(path)
 
 
-    def query(self, gbd_query=None, hashes=[], resolve=[], collapse="group_concat", group_by=None, join_type="LEFT"):
+    def build_query(self, gbd_query=None, hashes=[], resolve=[], collapse="group_concat", group_by=None, join_type="LEFT", profile=None):
+        """ Translate query to sql
+
+            Args: see query()
+
+            Returns:
+            tuple: sql query string, list of result column names
+            Raises:
+            GBDException, if query can not be parsed
+        """
+        try:
+            start = time.perf_counter()
+            query_builder = GBDQuery(self.database, gbd_query)
+            parsed = time.perf_counter()
+            sql = query_builder.build_query(hashes, resolve, group_by, join_type, collapse)
+            if profile is not None:
+                (profile.parse, profile.generate, profile.sql) = (parsed - start, time.perf_counter() - parsed, sql)
+        except ParserException as err:
+            if self.verbose:
+                util.eprint(traceback.format_exc())
+            raise GBDException("Parser Error with Query '{}': {}".format(gbd_query, str(err)))
+        group = group_by or query_builder.determine_group_by(resolve)
+        cols = [ p.split(':') for p in [ group ] + resolve ]
+        cols = [ c[0] if len(c) == 1 else c[1] for c in cols ]
+        return sql, cols
+
+
+    def query(self, gbd_query=None, hashes=[], resolve=[], collapse="group_concat", group_by=None, join_type="LEFT", as_arrow=False, profile=None):
         """ Query the database
 
             Args:
@@ -72,27 +128,152 @@ class GBD:
             collapse (str): collapse function: min, max, avg, count, sum, group_concat, or none
             group_by (str): group results by that feature instead of hash (default)
             join_type (str): join type: left or inner
+            as_arrow (bool): return a pyarrow.Table with numeric columns where values are numeric (bypasses the result cache)
+            profile (QueryProfile): if given, it is filled with the timings of the query phases
 
             Returns:
-            pandas.DataFrame: query result
+            pandas.DataFrame: query result, columns of features with declared types are typed accordingly
         """
-        query_builder = GBDQuery(self.database, gbd_query)
+        if profile is not None:
+            profile.schema = self.load_time
+        sql, cols = self.build_query(gbd_query, hashes, resolve, collapse, group_by, join_type, profile)
+        declared = self.declared_types(resolve, group_by, collapse)
+        if as_arrow:
+            from gbd_core import export
+            types, chunks = export.typed_chunks(self.stream(sql, cols), cols, declared)
+            return export.arrow_table(chunks, cols, types)
+        if self.cache is not None:
+            key = (sql, tuple(cols), self.database.version())
+            df = self.cache.get(key)
+            if df is not None:
+                if profile is not None:
+                    (profile.rows, profile.cached) = (len(df.index), True)
+                return df.copy()
         try:
-            sql = query_builder.build_query(hashes, resolve, group_by, join_type, collapse)
-        except tatsu.exceptions.FailedParse as err:
+            result = self.database.query(sql, profile)
+        except sqlite3.OperationalError as err:
             if self.verbose:
                 util.eprint(traceback.format_exc())
-            raise GBDException("Parser Error with Query '{}': {}".format(gbd_query, str(err)))
+            raise GBDException("Database Operational Error: {}".format(str(err)))
+        import pandas as pd  # imported on demand, pandas dominates the startup time of the command-line interface
+        start = time.perf_counter()
+        df = pd.DataFrame(result, columns=cols)
+        for (col, datatype) in zip(cols, declared):
+            if datatype == "int":
+                df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+            elif datatype == "real":
+                df[col] = pd.to_numeric(df[col], errors="coerce").astype("float64")
+            elif datatype == "category":
+                df[col] = df[col].astype("category")
+        if profile is not None:
+            (profile.frame, profile.rows) = (time.perf_counter() - start, len(df.index))
+        if self.cache is not None:
+            self.cache.put(key, df.copy())
+        return df
+
+
+    def query_iter(self, gbd_query=None, hashes=[], resolve=[], collapse="group_concat", group_by=None, join_type="LEFT", chunk_size=10000, as_frame=False):
+        """ Query the database and stream the result from the cursor (bypasses the result cache)
+
+            Args:
+            see query()
+            chunk_size (int): number of rows fetched from the cursor at once
+            as_frame (bool): yield pandas.DataFrame chunks instead of single rows
+
+            Returns:
+            generator: result rows (tuples) or DataFrame chunks of at most chunk_size rows
+            Raises:
+            GBDException, if query can not be parsed (immediately) or fails (during iteration)
+        """
+        sql, cols = self.build_query(gbd_query, hashes, resolve, collapse, group_by, join_type)
+        chunks = self.stream(sql, cols, chunk_size)
+        if as_frame:
+            import pandas as pd
+            return (pd.DataFrame(rows, columns=cols) for rows in chunks)
+        return (row for rows in chunks for row in rows)
+
+
+    def stream(self, sql, cols, chunk_size=10000):
+        """ Run sql query (see build_query()) and yield lists of at most chunk_size result rows """
         try:
-            result = self.database.query(sql)
+            yield from self.database.query_iter(sql, chunk_size)
         except sqlite3.OperationalError as err:
             if self.verbose:
                 util.eprint(traceback.format_exc())
             raise GBDException("Database Operational Error: {}".format(str(err)))
-        group = group_by or query_builder.determine_group_by(resolve)
-        cols = [ p.split(':') for p in [ group ] + resolve ]
-        cols = [ c[0] if len(c) == 1 else c[1] for c in cols ]
-        return pd.DataFrame(result, columns=cols)
+
+
+    def declared_types(self, resolve=[], group_by=None, collapse="group_concat"):
+        """ Determine result column types from the declared types of the resolved features
+
+            Args: see query()
+
+            Returns: list of "int", "real", "text", "category" or None (if undeclared) per result column
+        """
+        collapse = (collapse or "none").lower()
+        group = group_by or GBDQuery(self.database, None).determine_group_by(resolve)
+        result = [ ]
+        for feature in [ group ] + resolve:
+            finfo = self.database.find(feature)
+            if collapse == "count":
+                result.append("int")
+            elif finfo.column == "hash":
+                result.append("text")
+            elif finfo.datatype == "text":
+                result.append(None)
+            elif collapse == "group_concat" and finfo.default is None:
+                result.append("text")  # concatenation of multiple values
+            elif collapse == "avg":
+                result.append("real" if finfo.is_numeric() else None)
+            else:
+                result.append(finfo.datatype)
+        return result
+
+
+    def column_types(self, sql, cols, declared=None):
+        """ Determine result column types of sql query (see build_query())
+
+            Args:
+            declared (list): declared types (see declared_types()), these take precedence over types inferred from the result
+
+            Returns: list of "int", "real", "text" or "category" per column
+        """
+        from gbd_core import export
+        if declared and all(declared):
+            return declared
+        return export.result_types(self.stream(sql, cols), cols, declared)
+
+
+    def explain(self, gbd_query=None, hashes=[], resolve=[], collapse="group_concat", group_by=None, join_type="LEFT"):
+        """ Explain how sqlite executes the query
+
+            Args: see query()
+
+            Returns:
+            tuple: sql query string, list of query plan lines (indented by nesting level)
+        """
+        sql, cols = self.build_query(gbd_query, hashes, resolve, collapse, group_by, join_type)
+        try:
+            rows = self.database.query("EXPLAIN QUERY PLAN " + sql)
+        except sqlite3.OperationalError as err:
+            raise GBDException("Database Operational Error: {}".format(str(err)))
+        depth = { 0: -1 }
+        plan = [ ]
+        for (node, parent, _, detail) in rows:
+            depth[node] = depth.get(parent, -1) + 1
+            plan.append("  " * depth[node] + detail)
+        return sql, plan
+
+
+    def get_cache_info(self):
+        """ Get hit/miss counters of the caches for parsed queries, generated sql and (if enabled) query results
+
+            Returns: dictionary of cache name to counters
+        """
+        info = { 'ast': Parser.cache.info(), 'sql': GBDQuery.cache.info() }
+        if self.cache is not None:
+            info['result'] = self.cache.info()
+        return info
 
 
     def set_values(self, name, value, hashes, target_db=None):
@@ -114,6 +295,24 @@ class GBD:
         self.database.set_values(name, value, hashes, target_db)
 
 
+    def set_values_bulk(self, name, pairs, target_db=None, batch_size=None):
+        """ Set feature values for many hashes in one transaction
+
+            Args:
+            name (str): feature name
+            pairs (iterable): (hash, value) tuples, may be a generator
+            target_db (str, optional): name of target database
+            if None, default database (first in list) is used
+            batch_size (int, optional): number of rows written per executemany call
+
+            Raises:
+            GBDException, if feature does not exist
+        """
+        if not self.feature_exists(name, target_db):
+            raise GBDException("Feature '{}' does not exist".format(name))
+        self.database.set_values_bulk(name, pairs, target_db, batch_size)
+
+
     def reset_values(self, feature, values=[], hashes=[], target_db=None):
         """ Reset feature value for given hashes 
             
@@ -129,16 +328,7 @@ class GBD:
         """
         if not self.feature_exists(feature, target_db):
             raise GBDException("Feature '{}' does not exist".format(feature))
-        if len(values) and len(hashes):
-            for values_slice in util.slice_iterator(values, 10):
-                for hashes_slice in util.slice_iterator(hashes, 10):
-                    self.database.delete(feature, values_slice, hashes_slice, target_db)
-        elif len(values):
-            for values_slice in util.slice_iterator(values, 10):
-                self.database.delete(feature, values_slice, [], target_db)
-        elif len(hashes):
-            for hashes_slice in util.slice_iterator(hashes, 10):
-                self.database.delete(feature, [], hashes_slice, target_db)
+        self.database.delete(feature, values, hashes, target_db)
 
 
     def delete_hashes(self, hashes, target_db=None):
@@ -168,6 +358,26 @@ class GBD:
             return [ db for db in self.database.get_databases() if self.database.dcontext(db) == context ]
 
 
+    def checkpoint(self, databases=None, mode="passive"):
+        """ Checkpoint write-ahead logs of databases in WAL mode
+
+            Args:
+            databases (list): database names, if None all databases are checkpointed
+            mode (str): checkpoint mode (passive, full, restart or truncate)
+
+            Returns: list of (database, busy, frames in log, frames checkpointed)
+
+            Raises:
+            GBDException, if a database does not exist or the mode is unknown
+        """
+        try:
+            return self.database.checkpoint(databases, mode)
+        except DatabaseException as e:
+            raise GBDException(str(e))
+        except sqlite3.OperationalError as err:
+            raise GBDException("Database Operational Error: {}".format(str(err)))
+
+
     def get_database_path(self, dbname):
         """ Get path for given database name
 
@@ -202,18 +412,28 @@ class GBD:
             return list(set([ self.database.dcontext(db) for db in dbs ]))
 
 
-    def get_feature_info(self, fname):
-        """ Retrieve information about a specific feature"""
-        finfo = self.database.find(fname)
-        df = self.query(resolve=[ fname ], collapse=None)
-        numcol = df[fname].apply(lambda x: pd.to_numeric(x, errors = 'coerce'))
+    def get_feature_info(self, fname, target_db=None, top=10):
+        """ Retrieve information about a specific feature
+
+            Args:
+            fname (str): feature name
+            target_db (str): database name
+            if None, the first database which contains the feature is used
+            top (int): number of most frequent non-numeric values to report
+
+            Returns: dictionary of feature properties and value statistics (see Database.feature_stats())
+        """
+        finfo = self.database.find(fname, target_db)
+        stats = self.database.feature_stats(finfo.name, finfo.database, top)
         return {
             'feature_name': fname,
-            'feature_count': len(df.index),
+            'feature_count': stats['count'],
+            'feature_distinct': stats['distinct'],
             'feature_default': finfo.default,
-            'feature_min': numcol.min(),
-            'feature_max': numcol.max(),
-            'feature_values': " ".join([ val for val in df[fname].unique() if val and not util.is_number(val) ])
+            'feature_type': finfo.datatype,
+            'feature_min': stats['min'],
+            'feature_max': stats['max'],
+            'feature_values': " ".join([ str(val) for (val, _) in stats['top'] if val ])
         }
 
     
@@ -245,7 +465,7 @@ class GBD:
         return name in self.get_features(dbname)
 
 
-    def create_feature(self, name: str, default_value: str=None, target_db: str=None):
+    def create_feature(self, name: str, default_value: str=None, target_db: str=None, index: bool=False, datatype: str="text"):
         """ Creates feature with given name
 
             Args:
@@ -254,6 +474,9 @@ class GBD:
             if None, a multi-valued (1:n) feature is created
             target_db (str): database name 
             if None, default database (fist in list) is used
+            index (bool): create an index for lookups by feature value
+            datatype (str): declared type of feature values: text, int, real, or category
+            numeric constraints on int and real features are evaluated without casts
 
             Returns: None
 
@@ -261,7 +484,7 @@ class GBD:
             GBDException, if feature already exists in target_db
         """
         if not self.feature_exists(name, target_db):
-            self.database.create_feature(name, default_value, target_db, False)
+            self.database.create_feature(name, default_value, target_db, False, index, datatype)
         else:
             raise GBDException("Feature '{}' does already exist".format(name))
 
@@ -317,6 +540,8 @@ class GBD:
             new_name (str): new feature name
             target_db (str): name of database to copy feature to
             if None, default database (fist in list) is used
+            gbd_query (str): copy only values of hashes in the query result
+            hashes (list): copy only values of the given hashes
 
             Returns: None
         """
@@ -324,9 +549,93 @@ class GBD:
             raise GBDException("Feature '{}' does not exist".format(old_name))
         
         if not self.feature_exists(new_name, target_db):
-            self.create_feature(new_name, target_db=target_db)
+            self.create_feature(new_name, target_db=target_db, datatype=self.database.find(old_name).datatype)
+
+        self.database.copy_feature(old_name, new_name, target_db, self.select_hashes(gbd_query, hashes))
+
+
+    def move_feature(self, name, target_db, source_db=None):
+        """ Moves feature with given name to another database
 
-        hashes = list(self.query(gbd_query=gbd_query, hashes=hashes)["hash"])
+            Args:
+            name (str): feature name
+            target_db (str): name of database to move feature to
+            source_db (str): name of database to move feature from
+            if None, the first database which contains the feature is used
 
-        self.database.copy_feature(old_name, new_name, target_db, hashes)
+            Returns: None
 
+            Raises:
+            GBDException, if feature does not exist in source_db or does already exist in target_db
+        """
+        if not self.feature_exists(name, source_db):
+            raise GBDException("Feature '{}' does not exist".format(name))
+        if self.feature_exists(name, target_db):
+            raise GBDException("Feature '{}' does already exist in {}".format(name, target_db))
+        source = self.database.finfo(name, source_db)
+        if source.default is None and Database.sqlite3_version() < 3.35:
+            # the foreign key column of the feature would remain in the source database
+            raise GBDException("Cannot move feature '{}' with SQLite versions < 3.35".format(name))
+        index = name in [ feature for (_, feature) in self.get_indexes(source.database) ]
+        self.create_feature(name, source.default, target_db, index, source.datatype)
+        self.database.copy_feature(name, name, target_db, None, source.database)
+        self.database.delete_feature(name, source.database)
+
+
+    def select_hashes(self, gbd_query=None, hashes=[]):
+        # temporary table of hashes selected by query and hash list, or None if there is no restriction
+        if gbd_query:
+            sql, cols = self.build_query(gbd_query, hashes, collapse=None)
+            return self.database.hash_table_from_query(sql)
+        elif len(hashes):
+            return self.database.hash_table(hashes)
+        return None
+
+
+    def get_indexes(self, target_db=None):
+        """ Get indexes created for features
+
+            Args:
+            target_db (str): database name
+            if None, default database (fist in list) is used
+
+            Returns: list of (index name, feature name) tuples
+        """
+        return self.database.get_indexes(target_db)
+
+
+    def create_indexes(self, names=[], target_db=None):
+        """ Create covering indexes for lookups by feature value
+            and update the statistics of the query planner
+
+            Args:
+            names (list): feature names
+            if empty, all features in target_db are indexed
+            target_db (str): database name
+            if None, default database (fist in list) is used
+
+            Raises:
+            GBDException, if a feature does not exist in target_db
+        """
+        dbname = target_db or self.database.maindb
+        for name in names or self.get_features(dbname):
+            if not self.feature_exists(name, dbname):
+                raise GBDException("Feature '{}' does not exist".format(name))
+            self.database.create_index(name, dbname)
+        self.database.analyze(dbname)
+
+
+    def drop_indexes(self, names=[], target_db=None):
+        """ Drop indexes of features
+
+            Args:
+            names (list): feature names
+            if empty, all indexes in target_db are dropped
+            target_db (str): database name
+            if None, default database (fist in list) is used
+        """
+        dbname = target_db or self.database.maindb
+        for name in names or [ fname for (_, fname) in self.get_indexes(dbname) ]:
+            if not self.feature_exists(name, dbname):
+                raise GBDException("Feature '{}' does not exist".format(name))
+            self.database.drop_index(name, dbname)
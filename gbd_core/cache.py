@@ -0,0 +1,271 @@
+
+# MIT License
+
+# Copyright (c) 2023 Markus Iser, Karlsruhe Institute of Technology (KIT)
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+import os
+import pickle
+import hashlib
+import threading
+import time
+
+from collections import OrderedDict
+
+from gbd_core import util
+
+
+class LRUCache:
+    """ In-process least-recently-used cache with hit/miss counters
+
+        Bounded by number of entries (maxsize) and, if a sizeof function is given, by total size (maxbytes)
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            while len(self.entries) > self.maxsize or self.maxbytes is not None and self.nbytes > self.maxbytes:
+                self.nbytes -= self.entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def info(self):
+        return { 'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.nbytes }
+
+
+class DiskCache:
+    """ On-disk least-recently-used cache for pandas DataFrames with hit/miss counters
+
+        Entries are stored as one file per key in the given directory, either pickled or in Arrow IPC (feather) format.
+        The latter requires pyarrow. Least recently used entries are evicted when the directory grows beyond maxbytes.
+    """
+
+    def __init__(self, path, maxbytes=2**30, fmt="pickle"):
+        if not fmt in [ "pickle", "arrow" ]:
+            raise ValueError("Unknown cache format '{}'".format(fmt))
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.maxbytes = maxbytes
+        self.fmt = fmt
+        self.hits = 0
+        self.misses = 0
+
+    def filename(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, digest + (".pkl" if self.fmt == "pickle" else ".arrow"))
+
+    def get(self, key, default=None):
+        filename = self.filename(key)
+        try:
+            if self.fmt == "pickle":
+                with open(filename, "rb") as f:
+                    value = pickle.load(f)
+            else:
+                import pandas as pd
+                value = pd.read_feather(filename)
+            os.utime(filename)  # mark as recently used
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        filename = self.filename(key)
+        tmpname = "{}.{}.tmp".format(filename, os.getpid())
+        if self.fmt == "pickle":
+            with open(tmpname, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            value.to_feather(tmpname, compression="lz4")
+        os.replace(tmpname, filename)
+        self.evict()
+
+    def evict(self):
+        entries = [ entry for entry in os.scandir(self.path) if entry.is_file() and not entry.name.endswith(".tmp") ]
+        entries = sorted([ (entry.stat().st_mtime_ns, entry.stat().st_size, entry.path) for entry in entries ])
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in entries:
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                os.remove(entry.path)
+
+    def info(self):
+        entries = [ entry.stat().st_size for entry in os.scandir(self.path) if entry.is_file() ]
+        return { 'hits': self.hits, 'misses': self.misses, 'entries': len(entries), 'bytes': sum(entries) }
+
+
+class HashCache:
+    """ Persistent cache of benchmark hashes in an sqlite database
+
+        Entries are keyed on the identity of the file (path, device, inode, size and modification time) and the context,
+        such that only new or modified files are hashed again. Least recently used entries are evicted when the cache grows beyond maxentries.
+    """
+
+    # entries are evicted every so many insertions, and their usage time is updated at this resolution (seconds)
+    EVICT_INTERVAL = 1000
+    USED_RESOLUTION = 3600
+
+    # files modified this recently (seconds) are not cached, as further modifications might not change their modification time
+    RACY_INTERVAL = 2
+
+    def __init__(self, path, maxentries=2**20):
+        import sqlite3
+        self.path = path
+        self.pid = os.getpid()
+        self.maxentries = maxentries
+        self.inserts = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # autocommit, the cache is shared by concurrent processes (e.g. parallel gbd init local)
+        self.con = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.con.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT NOT NULL, context TEXT NOT NULL, dev INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, "
+                            "hash TEXT NOT NULL, used REAL, PRIMARY KEY (path, context, dev, inode, size, mtime_ns))")
+        self.con.execute("CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used)")
+
+    def key(self, path, context):
+        st = os.stat(path)
+        return (os.path.abspath(path), context, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, key):
+        import sqlite3
+        try:
+            with self.lock:
+                row = self.con.execute("SELECT hash, used FROM hashes WHERE path=? AND context=? AND dev=? AND inode=? AND size=? AND mtime_ns=?", key).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                self.hits += 1
+                (hash, used) = row
+                now = time.time()
+                if used < now - self.USED_RESOLUTION:
+                    self.con.execute("UPDATE hashes SET used=? WHERE path=? AND context=? AND dev=? AND inode=? AND size=? AND mtime_ns=?", (now, ) + key)
+                return hash
+        except sqlite3.Error:
+            return None
+
+    def put(self, key, hash):
+        """ Cache the hash of the file with the given key, unless the file was modified in the meantime or very recently """
+        import sqlite3
+        try:
+            if self.key(key[0], key[1]) != key or key[5] > (time.time() - self.RACY_INTERVAL) * 10**9:
+                return
+            with self.lock, self.con:
+                # entries of previous versions of the file are replaced
+                self.con.execute("BEGIN IMMEDIATE")
+                self.con.execute("DELETE FROM hashes WHERE path=? AND context=?", key[:2])
+                self.con.execute("INSERT INTO hashes (path, context, dev, inode, size, mtime_ns, hash, used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", key + (hash, time.time()))
+                self.inserts += 1
+            if self.inserts % self.EVICT_INTERVAL == 0:
+                self.evict()
+        except (OSError, sqlite3.Error):
+            pass
+
+    def compute(self, path, context, hashfunc):
+        """ Hash of the given file in the given context, computed by hashfunc(path) if it is not in the cache """
+        try:
+            key = self.key(path, context)
+        except OSError:
+            return hashfunc(path)
+        hash = self.get(key)
+        if hash is None:
+            hash = hashfunc(path)
+            self.put(key, hash)
+        return hash
+
+    def evict(self):
+        with self.lock:
+            self.con.execute("DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.maxentries, ))
+
+    def clear(self):
+        with self.lock:
+            self.con.execute("DELETE FROM hashes")
+
+    def close(self):
+        self.con.close()
+
+    def info(self):
+        with self.lock:
+            (entries, ) = self.con.execute("SELECT COUNT(*) FROM hashes").fetchone()
+        return { 'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': os.path.getsize(self.path) }
+
+
+hash_cache_instance = None
+
+def hash_cache():
+    """ Hash cache of the current process (see HashCache)
+
+        Located in cache_dir() by default, $GBD_HASH_CACHE can specify another location or be set to 'off' to disable the cache.
+
+        Returns: HashCache or None if disabled or not available
+    """
+    import sqlite3
+    global hash_cache_instance
+    setting = os.environ.get('GBD_HASH_CACHE', '')
+    if setting.lower() == 'off':
+        return None
+    path = setting or os.path.join(util.cache_dir(), "hashes.db")
+    # forked workers must not use the connection of their parent
+    if hash_cache_instance is None or hash_cache_instance.path != path or hash_cache_instance.pid != os.getpid():
+        try:
+            hash_cache_instance = HashCache(path)
+        except sqlite3.Error as e:
+            util.eprint("Hash cache not available: {}".format(e))
+            return None
+    return hash_cache_instance
+
+
+def dataframe_size(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
@@ -75,10 +75,15 @@ def get_context_by_suffix(benchmark):
                 return context
     return None
 
-def identify(path, ct=None):
+def identify(path, ct=None, cache=True):
     context = ct or get_context_by_suffix(path)    
     if context is None:
         raise Exception("Unable to associate context: " + path)
     else:
         idf = idfunc(context)
+        if cache:
+            from gbd_core.cache import hash_cache
+            hashes = hash_cache()
+            if hashes is not None:
+                return hashes.compute(path, context, idf)
         return idf(path)
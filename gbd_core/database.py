@@ -13,28 +13,123 @@
 # The above copyright notice and this permission notice shall be included in all
 # copies or substantial portions of the Software.
 
+import os
+import json
+import time
+import hashlib
 import sqlite3
+import threading
 import typing
 
 from pprint import pprint
+from collections import OrderedDict
 
 from gbd_core.util import eprint
 from gbd_core.schema import Schema, FeatureInfo
+from gbd_core.cache import LRUCache
 from gbd_core import contexts
 
 
+# hash lists longer than this are loaded into temporary tables instead of being pasted into queries
+HASH_TABLE_THRESHOLD = 1000
+
+# number of temporary hash tables kept for reuse by repeated queries
+HASH_TABLE_CACHE_SIZE = 8
+
+# source rows per statement in copies, progress is reported between chunks
+COPY_CHUNK_SIZE = 100000
+
+# pragmas applied to each connection by journaling profile, in WAL mode readers and a writer do not block each other
+JOURNAL_PROFILES = { "default": dict(), "wal": { "journal_mode": "WAL", "synchronous": "NORMAL" } }
+
+# modes of PRAGMA wal_checkpoint
+CHECKPOINT_MODES = [ "passive", "full", "restart", "truncate" ]
+
+
 class DatabaseException(Exception):
     pass
 
 
+class ConnectionPool:
+    """ Long-lived sqlite3 connections, one per database and thread
+
+        Connections are opened lazily on first checkout and stay open until close() is called.
+        Each thread checks out its own connection, such that sqlite3 objects are never shared between threads.
+        Pragmas are applied once when a connection is opened.
+    """
+
+    def __init__(self, timeout=10, pragmas=dict()):
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = [ ]
+
+    def connect(self, target):
+        con = sqlite3.connect(target, uri=target.startswith("file:"), timeout=self.timeout, check_same_thread=False)
+        for (key, value) in self.pragmas.items():
+            con.execute("PRAGMA {}={}".format(key, value))
+        with self.lock:
+            self.connections.append(con)
+        return con
+
+    def get(self, target) -> sqlite3.Connection:
+        """ Check out the calling thread's connection to target (database path or sqlite uri) """
+        if not hasattr(self.local, "connections"):
+            self.local.connections = dict()
+        if not target in self.local.connections:
+            self.local.connections[target] = self.connect(target)
+        return self.local.connections[target]
+
+    def commit(self):
+        """ Commit pending transactions on the calling thread's connections """
+        for con in getattr(self.local, "connections", dict()).values():
+            if con.in_transaction:
+                con.commit()
+
+    def rollback(self):
+        """ Roll back pending transactions on the calling thread's connections """
+        for con in getattr(self.local, "connections", dict()).values():
+            if con.in_transaction:
+                con.rollback()
+
+    def close(self):
+        with self.lock:
+            for con in self.connections:
+                con.close()
+            self.connections = [ ]
+        self.local = threading.local()
+
+
 class Database:
 
-    def __init__(self, path_list: list, verbose=False, autocommit=True):
+    # feature statistics by feature address and database version
+    stats_cache = LRUCache(maxsize=1024)
+
+    # availability of the JSON1 extension, see sqlite3_has_json1()
+    json1 = None
+
+    def __init__(self, path_list: list, verbose=False, autocommit=True, journal="default", busy_timeout=10, autocheckpoint=None):
+        """ Open the given databases (sqlite files or CSV files)
+
+            journal: journaling profile (see JOURNAL_PROFILES), the journal mode persists in the database files and applies to other processes too
+            busy_timeout: seconds to wait for locks held by other connections
+            autocheckpoint: size of the write-ahead log (in pages) which triggers a checkpoint (default: sqlite's default of 1000 pages)
+        """
+        if not journal in JOURNAL_PROFILES:
+            raise DatabaseException("Unknown journaling profile '{}'".format(journal))
+        pragmas = dict(JOURNAL_PROFILES[journal])
+        if autocheckpoint is not None:
+            pragmas["wal_autocheckpoint"] = int(autocheckpoint)
         self.verbose = verbose
+        self.pool = ConnectionPool(timeout=busy_timeout, pragmas=pragmas)
         self.schemas = self.init_schemas(path_list)
         self.features = self.init_features()
-        self.connection = sqlite3.connect("file::memory:?cache=shared", uri=True, timeout=10)
+        self.fingerprint = None
+        self.connection = self.pool.connect("file::memory:?cache=shared")
         self.cursor = self.connection.cursor()
+        self.hash_tables = OrderedDict()
+        self.temp_changes = 0
         self.maindb = None
         self.autocommit = autocommit
         schema: Schema
@@ -51,8 +146,8 @@ class Database:
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        self.connection.commit()
-        self.connection.close()
+        self.commit()
+        self.pool.close()
 
 
     # returns major version of sqlite3 as float
@@ -60,11 +155,25 @@ class Database:
     def sqlite3_version(cls):
         return float(sqlite3.sqlite_version.rsplit('.', 1)[0])
 
+    # whether sqlite3 is built with the JSON1 extension (built in since 3.38)
+    @classmethod
+    def sqlite3_has_json1(cls):
+        if cls.json1 is None:
+            con = sqlite3.connect(":memory:")
+            try:
+                con.execute("SELECT json_array(1)")
+                cls.json1 = True
+            except sqlite3.OperationalError:
+                cls.json1 = False
+            finally:
+                con.close()
+        return cls.json1
+
 
     def init_schemas(self, path_list) -> typing.Dict[str, Schema]:
         result = dict()
         for path in path_list:
-            schema = Schema.create(path)
+            schema = Schema.create(path, self.pool)
             if not schema.dbname in result:
                 result[schema.dbname] = schema
             elif schema.is_in_memory():
@@ -95,10 +204,30 @@ class Database:
         return result
 
 
-    def query(self, q):
+    def query(self, q, profile=None):
+        if self.verbose:
+            eprint(q)
+        if profile is None:
+            return self.cursor.execute(q).fetchall()
+        start = time.perf_counter()
+        cursor = self.cursor.execute(q)
+        executed = time.perf_counter()
+        result = cursor.fetchall()
+        (profile.execute, profile.fetch) = (executed - start, time.perf_counter() - executed)
+        return result
+
+    def query_iter(self, q, chunk_size=10000):
         if self.verbose:
             eprint(q)
-        return self.cursor.execute(q).fetchall()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(q)
+            rows = cursor.fetchmany(chunk_size)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(chunk_size)
+        finally:
+            cursor.close()
 
     def execute(self, q):
         if self.verbose:
@@ -109,11 +238,112 @@ class Database:
 
     def commit(self):
         self.connection.commit()
+        self.pool.commit()
 
     def set_auto_commit(self, autocommit):
         self.autocommit = autocommit
 
 
+    def hash_restriction(self, column, hashes):
+        """ SQL condition restricting column to the given hashes
+
+            Short lists are pasted into the query, long lists are loaded into a temporary table (see hash_table())
+        """
+        if len(hashes) <= HASH_TABLE_THRESHOLD:
+            return "{} IN ('{}')".format(column, "', '".join(hashes))
+        else:
+            return "{} IN (SELECT hash FROM {})".format(column, self.hash_table(hashes))
+
+    def hash_table(self, hashes):
+        """ Temporary table (on the reading connection) which holds the given hashes
+
+            Tables are named by content and reused by repeated queries on the same hashes
+
+            Returns: qualified table name
+        """
+        hashes = sorted(set(hashes))  # sorted insertion appends to the table's b-tree
+        digest = hashlib.sha1("\n".join(hashes).encode("utf-8")).hexdigest()
+        name = "_hashes_" + digest[:16]
+        if name in self.hash_tables:
+            self.hash_tables.move_to_end(name)
+        elif self.connection.in_transaction:
+            # part of the caller's pending transaction, not cached as a rollback would drop the table
+            changes = self.connection.total_changes
+            Schema.fill_temp_table(self.connection, name, "hash", hashes)
+            self.temp_changes += self.connection.total_changes - changes
+        else:
+            changes = self.connection.total_changes
+            Schema.fill_temp_table(self.connection, name, "hash", hashes)
+            while len(self.hash_tables) >= HASH_TABLE_CACHE_SIZE:
+                (evicted, _) = self.hash_tables.popitem(last=False)
+                self.connection.execute("DROP TABLE IF EXISTS temp.{}".format(evicted))
+            self.connection.commit()  # ends the transaction opened by the temporary table, it would hold read locks
+            self.temp_changes += self.connection.total_changes - changes
+            self.hash_tables[name] = len(hashes)
+        return "temp." + name
+
+    def hash_table_from_query(self, sql):
+        """ Temporary table (on the reading connection) which holds the hashes selected by sql (single column)
+
+            Returns: qualified table name
+        """
+        changes = self.connection.total_changes
+        pending = self.connection.in_transaction
+        self.connection.execute("DROP TABLE IF EXISTS temp._gbd_selection")
+        self.connection.execute("CREATE TEMP TABLE _gbd_selection (hash TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.connection.execute("INSERT OR IGNORE INTO temp._gbd_selection SELECT * FROM ({})".format(sql))
+        if not pending:
+            self.connection.commit()  # ends the transaction opened by the temporary table, it would hold read locks
+        self.temp_changes += self.connection.total_changes - changes
+        return "temp._gbd_selection"
+
+
+    def version(self):
+        """ Snapshot of the state of all attached databases, changes whenever one of them is written
+
+            Returns: tuple of PRAGMA data_version and file status (of database file and write-ahead log) per database,
+            and the number of changes made through the reading connection itself (which data_version does not count)
+        """
+        result = [ ]
+        for schema in self.schemas.values():
+            (version, ) = self.connection.execute("PRAGMA {}.data_version".format(schema.dbname)).fetchone()
+            paths = [ ] if schema.is_in_memory() else [ schema.path, schema.path + "-wal" ]
+            stats = [ os.stat(path) for path in paths if os.path.exists(path) ]
+            result.append((schema.dbname, version, tuple((st.st_mtime_ns, st.st_size) for st in stats)))
+        return (tuple(result), self.connection.total_changes - self.temp_changes)
+
+
+    def schema_version(self):
+        """ Fingerprint of attached databases and their features, changes whenever features are created, renamed or deleted """
+        if self.fingerprint is None:
+            schemas = [ (s.dbname, s.path, s.context) for s in self.schemas.values() ]
+            features = [ (name, [ (f.database, f.table, f.column, f.default, f.datatype) for f in infos ]) for (name, infos) in self.features.items() ]
+            self.fingerprint = hashlib.sha1(repr((schemas, features)).encode("utf-8")).hexdigest()
+        return self.fingerprint
+
+
+    def checkpoint(self, databases=None, mode="passive"):
+        """ Checkpoint write-ahead logs, i.e., transfer their content into the database files
+
+            Returns: list of (database, busy, frames in log, frames checkpointed) per database in WAL mode
+        """
+        if not mode in CHECKPOINT_MODES:
+            raise DatabaseException("Unknown checkpoint mode '{}'".format(mode))
+        result = [ ]
+        for dbname in databases or self.get_databases():
+            schema = self.schemas.get(dbname)
+            if schema is None:
+                raise DatabaseException("Database '{}' not found".format(dbname))
+            if schema.is_in_memory():
+                continue
+            con = self.pool.get(schema.path)
+            (journal_mode, ) = con.execute("PRAGMA journal_mode").fetchone()
+            if journal_mode.lower() == "wal":
+                (busy, log, checkpointed) = con.execute("PRAGMA wal_checkpoint({})".format(mode.upper())).fetchone()
+                result.append((dbname, busy, log, checkpointed))
+        return result
+
+
     def dexists(self, dbname):
         return dbname in self.schemas.keys()
 
@@ -218,31 +448,50 @@ class Database:
         return list(set(tables))
 
 
-    def create_feature(self, name, default_value=None, target_db=None, permissive=False):
+    def create_feature(self, name, default_value=None, target_db=None, permissive=False, index=False, datatype="text"):
         db = target_db or self.maindb
-        created = self.schemas[db].create_feature(name, default_value, permissive)
+        created = self.schemas[db].create_feature(name, default_value, permissive, index, datatype)
         for finfo in created:
             if not finfo.name in self.features.keys():
                 self.features[finfo.name] = [ finfo ]
             else:
                 # this code disregards feature precedence by database position:
                 self.features[finfo.name].append(finfo)
+        self.fingerprint = None
+
+
+    def get_indexes(self, target_db=None):
+        db = target_db or self.maindb
+        return self.schemas[db].get_indexes()
+
+    def create_index(self, fname, target_db=None):
+        finfo = self.finfo(fname, target_db)
+        self.schemas[finfo.database].create_index(fname)
+
+    def drop_index(self, fname, target_db=None):
+        finfo = self.finfo(fname, target_db)
+        self.schemas[finfo.database].drop_index(fname)
+
+    def analyze(self, target_db=None):
+        db = target_db or self.maindb
+        self.schemas[db].execute("ANALYZE")
 
 
     def set_values(self, fname, value, hashes, target_db=None):
         finfo = self.finfo(fname, target_db)
         self.schemas[finfo.database].set_values(fname, value, hashes)
 
+    def set_values_bulk(self, fname, pairs, target_db=None, batch_size=None, commit=True):
+        finfo = self.finfo(fname, target_db)
+        self.schemas[finfo.database].set_values_bulk(fname, pairs, batch_size, commit)
+
 
     def rename_feature(self, fname, new_fname, target_db=None):
         Schema.valid_feature_or_raise(new_fname)
         finfo = self.finfo(fname, target_db)
         self.execute("ALTER TABLE {}.features RENAME COLUMN {} TO {}".format(finfo.database, fname, new_fname))
         if finfo.default is None:
-            con = sqlite3.connect(self.schemas[finfo.database].path)
-            with con as cursor:
-                cursor.execute("ALTER TABLE {} RENAME TO {}".format(fname, new_fname))
-            con.close()
+            self.schemas[finfo.database].execute("ALTER TABLE {} RENAME TO {}".format(fname, new_fname))
         self.features[fname].remove(finfo)
         if not len(self.features[fname]):
             del self.features[fname]
@@ -252,46 +501,105 @@ class Database:
         else:
             # this code disregards feature precedence by database position:
             self.features[new_fname].append(finfo)
+        self.fingerprint = None
 
 
     def delete_feature(self, fname, target_db=None):
         finfo = self.finfo(fname, target_db)
         if finfo.default is None:
             self.execute('DROP TABLE IF EXISTS {}.{}'.format(finfo.database, fname))
+            if Database.sqlite3_version() >= 3.35:
+                # foreign key column in main features table, older versions keep it
+                self.schemas[finfo.database].drop_index(fname)
+                self.execute("ALTER TABLE {}.features DROP COLUMN {}".format(finfo.database, fname))
         elif Database.sqlite3_version() >= 3.35:
+            # indexed columns cannot be dropped
+            self.schemas[finfo.database].drop_index(fname)
             self.execute("ALTER TABLE {}.{} DROP COLUMN {}".format(finfo.database, finfo.table, fname))
         else:
             raise DatabaseException("Cannot delete unique feature {} with SQLite versions < 3.35".format(fname))
         self.features[fname].remove(finfo)
         if not len(self.features[fname]):
             del self.features[fname]
+        self.fingerprint = None
+
+
+    def feature_stats(self, fname, target_db=None, top=10):
+        """ Aggregate statistics of feature values, computed in SQL and cached until the next write
+
+            Returns: dictionary with number of values (count), number of distinct values (distinct),
+            minimum and maximum of numeric values (min, max; None if there are none),
+            and the most frequent non-numeric values (top; list of value, frequency pairs)
+        """
+        from gbd_core import export
+        finfo = self.finfo(fname, target_db)
+        key = (finfo.database, finfo.table, finfo.column, top, self.version())
+        stats = Database.stats_cache.get(key)
+        if stats is None:
+            export.register_functions(self.connection)
+            # the hint keeps the grouped values from being computed twice, older versions decide themselves
+            hint = "MATERIALIZED" if sqlite3.sqlite_version_info >= (3, 35, 0) else ""
+            ranked = """WITH ranked AS {h} (SELECT value, freq, gbd_type_rank(value) IN ({i}, {r}) AS numeric
+                            FROM (SELECT {c} AS value, COUNT(*) AS freq FROM {d}.{t} WHERE hash != 'None' GROUP BY {c}))
+                     """.format(h=hint, c=finfo.column, d=finfo.database, t=finfo.table, i=export.INTEGER, r=export.REAL)
+            sql_top = "SELECT value, freq FROM ranked WHERE NOT numeric ORDER BY freq DESC, value LIMIT {}".format(int(top))
+            sql = ranked + "SELECT TOTAL(freq), COUNT(*), MIN(CASE WHEN numeric THEN CAST(value AS NUMERIC) END), MAX(CASE WHEN numeric THEN CAST(value AS NUMERIC) END)"
+            if Database.sqlite3_has_json1():
+                sql = sql + ", (SELECT json_group_array(json_array(value, freq)) FROM ({}))".format(sql_top)
+            (count, distinct, vmin, vmax, *frequent) = self.query(sql + " FROM ranked")[0]
+            if frequent:
+                frequent = [ tuple(pair) for pair in json.loads(frequent[0]) ]
+            else:
+                frequent = [ tuple(pair) for pair in self.query(ranked + sql_top) ]
+            stats = { 'count': int(count), 'distinct': distinct, 'min': vmin, 'max': vmax, 'top': frequent }
+            Database.stats_cache.put(key, stats)
+        return stats
 
 
     def delete(self, fname, values=[], hashes=[], target_db=None):
         finfo = self.finfo(fname, target_db)
-        w1 = "{cl} IN ('{v}')".format(cl=finfo.column, v="', '".join(values))
-        w2 = "hash IN ('{h}')".format(h="', '".join(hashes))
-        where = "{} AND {}".format(w1 if len(values) else "1=1", w2 if len(hashes) else "1=1")
-        db = finfo.database
-        if finfo.default is None:
-            hashlist = [ r[0] for r in self.query("SELECT DISTINCT(hash) FROM {d}.{tab} WHERE {w}".format(d=db, tab=fname, w=where)) ]
-            self.execute("DELETE FROM {d}.{tab} WHERE {w}".format(d=db, tab=fname, w=where))
-            remaining = [ r[0] for r in self.query("SELECT DISTINCT(hash) FROM {d}.{tab} WHERE hash in ('{h}')".format(d=db, tab=fname, h="', '".join(hashlist))) ]
-            setnone = [ h for h in hashlist if not h in remaining ]
-            self.execute("UPDATE {d}.features SET {col} = 'None' WHERE hash IN ('{h}')".format(d=db, col=fname, h="', '".join(setnone)))
-        else:
-            self.execute("UPDATE {d}.features SET {col} = '{default}' WHERE {w}".format(d=db, col=fname, default=finfo.default, w=where))
+        self.schemas[finfo.database].delete_values(fname, values, hashes)
 
 
     def delete_hashes_entirely(self, hashes, target_db=None):
-        tables = self.get_tables([ target_db ])
-        for table in tables:
-            self.execute("DELETE FROM {}.{} WHERE hash IN ('{h}')".format(target_db, table, h="', '".join(hashes)))
+        db = target_db or self.maindb
+        self.schemas[db].delete_hashes(hashes)
 
 
-    def copy_feature(self, old_name, new_name, target_db, hashlist=[]):
-        old_finfo = self.find(old_name)
-        data = self.query("SELECT hash, {col} FROM {d}.{tab} WHERE hash IN ('{h}')".format(d=old_finfo.database, col=old_finfo.column, tab=old_finfo.table, h="', '".join(hashlist)))
-        for (hash, value) in data:
-            self.set_values(new_name, value, [hash], target_db)
+    def copy_feature(self, old_name, new_name, target_db=None, selection=None, source_db=None, chunk_size=None):
+        """ Copy values of a feature into an existing feature with INSERT ... SELECT in a single transaction
 
+            Args:
+            selection (str): table with column hash that restricts the copied hashes (see hash_table_from_query())
+            chunk_size (int): number of source rows per statement, progress is reported for copies of more than one chunk
+        """
+        source = self.finfo(old_name, source_db)
+        target = self.finfo(new_name, target_db or self.maindb)
+        src = "{}.{}".format(source.database, source.table)
+        tgt = "{}.{}".format(target.database, target.table)
+        where = "{}.hash != 'None'".format(src)
+        if selection is not None:
+            where = where + " AND {}.hash IN (SELECT hash FROM {})".format(src, selection)
+        if target.default is None:
+            sql = "INSERT OR IGNORE INTO {t} (hash, value) SELECT hash, {c} FROM {s} WHERE {w} AND {s}.rowid BETWEEN ? AND ?"
+        else:
+            sql = "INSERT INTO {t} (hash, {tc}) SELECT hash, {c} FROM {s} WHERE {w} AND {s}.rowid BETWEEN ? AND ? ON CONFLICT (hash) DO UPDATE SET {tc} = excluded.{tc}"
+        sql = sql.format(t=tgt, tc=target.column, s=src, c=source.column, w=where)
+        chunk_size = chunk_size or COPY_CHUNK_SIZE
+        (first, last) = self.connection.execute("SELECT MIN(rowid), MAX(rowid) FROM {}".format(src)).fetchone()
+        copied = 0
+        try:
+            for lower in range(first or 0, (last or -1) + 1, chunk_size):
+                if self.verbose:
+                    eprint(sql)
+                copied += self.connection.execute(sql, (lower, lower + chunk_size - 1)).rowcount
+                if last - first >= chunk_size:
+                    eprint("Copying {} to {}: {:.0f}% ({} values)".format(old_name, new_name, 100 * min(1, (lower + chunk_size - first) / (last - first + 1)), copied))
+            if target.default is None:
+                # features table refers to 1:n values by hash (or 'None' if there are none)
+                self.connection.execute("UPDATE {d}.features SET {t} = hash WHERE {t} = 'None' AND hash IN (SELECT hash FROM {d}.{t})".format(d=target.database, t=target.table))
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+        return copied
\ No newline at end of file
@@ -0,0 +1,218 @@
+
+# MIT License
+
+# Copyright (c) 2023 Markus Iser, Karlsruhe Institute of Technology (KIT)
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# Typed export of query results to csv, jsonl, Arrow IPC and Parquet.
+# Results are written chunk by chunk as they are fetched from the cursor.
+
+import sys
+import csv
+import json
+import pickle
+import tempfile
+
+from contextlib import nullcontext
+
+from gbd_core import util
+
+
+FORMATS = [ "text", "csv", "jsonl", "arrow", "parquet" ]
+BINARY_FORMATS = [ "arrow", "parquet" ]
+
+# rank of value types, the type of a column is the maximum rank of its values
+NULL, INTEGER, REAL, TEXT = 0, 1, 2, 3
+TYPE_NAMES = { NULL: "text", INTEGER: "int", REAL: "real", TEXT: "text" }
+
+
+def type_rank(value):
+    if value is None:
+        return NULL
+    if isinstance(value, int):
+        return INTEGER if -2**63 <= value < 2**63 else REAL
+    if isinstance(value, float):
+        return REAL
+    try:
+        number = int(value)
+        if str(number) == value:
+            return INTEGER if -2**63 <= number < 2**63 else REAL
+        elif value.strip().lstrip("+-").startswith("0"):
+            return TEXT  # leading zeros, e.g. identifiers
+    except ValueError:
+        pass
+    return REAL if util.is_number(value) else TEXT
+
+
+def register_functions(con):
+    """ Register gbd_type_rank(value) with sqlite connection, see type_rank() """
+    con.create_function("gbd_type_rank", 1, type_rank, deterministic=True)
+
+
+def column_ranks(rows, ranks):
+    """ Update the type ranks of result columns (see type_rank()) with the given result rows """
+    for (i, column) in enumerate(zip(*rows)):
+        for value in column:
+            if ranks[i] == TEXT:
+                break
+            ranks[i] = max(ranks[i], type_rank(value))
+    return ranks
+
+
+def column_types(rows, cols):
+    """ Determine the types of result columns from the given result rows
+
+        Args:
+        rows (list): result rows
+        cols (list): result column names
+
+        Returns:
+        list: one of "int", "real", "text" per column; hashes are always "text"
+        (declared feature types are handled in GBD.column_types())
+    """
+    ranks = column_ranks(rows, [ TEXT if col == "hash" else NULL for col in cols ])
+    return [ TYPE_NAMES[rank] for rank in ranks ]
+
+
+def typed_chunks(chunks, cols, declared=None):
+    """ Determine result column types by declared types, or from all result rows if undeclared
+
+        If types have to be inferred, the chunks are consumed and spooled to a temporary file,
+        such that the query runs only once and the types are settled before the first row is written.
+
+        Args:
+        chunks (iterable): lists of result rows
+        cols (list): result column names
+        declared (list): declared types or None per column (see GBD.declared_types())
+
+        Returns:
+        tuple: list of column types, iterator of all chunks
+    """
+    declared = declared or [ None for _ in cols ]
+    if all(declared):
+        return declared, iter(chunks)
+    spool = tempfile.TemporaryFile()
+    try:
+        types = result_types(spooled(chunks, spool), cols, declared)
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return types, replay(spool)
+
+
+def result_types(chunks, cols, declared=None):
+    """ Determine result column types by declared types, or from all result rows if undeclared (see typed_chunks()) """
+    declared = declared or [ None for _ in cols ]
+    ranks = [ TEXT if ctype or col == "hash" else NULL for (col, ctype) in zip(cols, declared) ]
+    for rows in chunks:
+        column_ranks(rows, ranks)
+    return [ ctype or TYPE_NAMES[rank] for (ctype, rank) in zip(declared, ranks) ]
+
+
+def spooled(chunks, spool):
+    for rows in chunks:
+        pickle.dump(rows, spool, protocol=pickle.HIGHEST_PROTOCOL)
+        yield rows
+
+
+def replay(spool):
+    with spool:
+        while True:
+            try:
+                yield pickle.load(spool)
+            except EOFError:
+                return
+
+
+def to_number(value, ctype):
+    # placeholders of missing values in typed features (e.g. 'None') are converted to None
+    try:
+        return int(value) if ctype == "int" else float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def converter(ctype):
+    if ctype in [ "int", "real" ]:
+        return lambda value: None if value is None else to_number(value, ctype)
+    else:
+        return lambda value: None if value is None else str(value)
+
+
+def arrow_schema(cols, types):
+    import pyarrow as pa
+    atypes = { "int": pa.int64(), "real": pa.float64(), "text": pa.string(), "category": pa.dictionary(pa.int32(), pa.string()) }
+    return pa.schema([ pa.field(col, atypes[ctype]) for (col, ctype) in zip(cols, types) ])
+
+
+def arrow_batches(chunks, schema, types):
+    """ Convert chunks of result rows to Arrow record batches of the given schema """
+    import pyarrow as pa
+    converters = [ converter(ctype) for ctype in types ]
+    for rows in chunks:
+        columns = zip(*rows) if len(rows) else [ [] for _ in converters ]
+        arrays = [ pa.array([ conv(value) for value in column ], type=field.type) for (conv, column, field) in zip(converters, columns, schema) ]
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def arrow_table(chunks, cols, types):
+    import pyarrow as pa
+    schema = arrow_schema(cols, types)
+    return pa.Table.from_batches(list(arrow_batches(chunks, schema, types)), schema=schema)
+
+
+def write(chunks, cols, types, fmt, output=None, delimiter=' ', header=False):
+    """ Write chunks of result rows to file
+
+        Args:
+        chunks (iterable): lists of result rows
+        cols (list): result column names
+        types (list): result column types (see column_types())
+        fmt (str): one of FORMATS
+        output (str): output filename, stdout if None
+        delimiter (str): column delimiter of text format
+        header (bool): write header line in text format (always written in csv)
+    """
+    if fmt in BINARY_FORMATS:
+        write_arrow(chunks, cols, types, fmt, output or sys.stdout.buffer)
+        return
+    with (open(output, "w", newline="") if output else nullcontext(sys.stdout)) as file:
+        if fmt == "text":
+            if header:
+                file.write(delimiter.join(cols) + "\n")
+            for rows in chunks:
+                file.writelines(delimiter.join([ "[None]" if item is None or item == "" else str(item) for item in row ]) + "\n" for row in rows)
+        elif fmt == "csv":
+            writer = csv.writer(file)
+            writer.writerow(cols)
+            for rows in chunks:
+                writer.writerows(rows)
+        elif fmt == "jsonl":
+            converters = [ converter(ctype) for ctype in types ]
+            for rows in chunks:
+                file.writelines(json.dumps({ col: conv(value) for (col, conv, value) in zip(cols, converters, row) }) + "\n" for row in rows)
+        else:
+            raise ValueError("Unknown format '{}'".format(fmt))
+
+
+def write_arrow(chunks, cols, types, fmt, output):
+    import pyarrow as pa
+    schema = arrow_schema(cols, types)
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(output, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_file(output, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+    with writer:
+        for batch in arrow_batches(chunks, schema, types):
+            writer.write_batch(batch)
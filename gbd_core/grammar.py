@@ -13,14 +13,179 @@
 # The above copyright notice and this permission notice shall be included in all
 # copies or substantial portions of the Software.
 
-import tatsu
 import json
+import re
 
 from gbd_core.database import Database, DatabaseException
+from gbd_core.cache import LRUCache
 
 class ParserException(Exception):
     pass
 
+
+class AST(dict):
+    """ Parse tree node, missing keys evaluate to None (as in tatsu's AST) """
+    def __missing__(self, key):
+        return None
+
+
+class QueryModel:
+    """ Hand-written recursive-descent parser for Parser.GRAMMAR
+
+        Produces the same AST as tatsu.compile(Parser.GRAMMAR) but does not compile the grammar at import time.
+        Like the PEG it implements, alternatives are tried in order and the first match is taken,
+        binary operators associate to the right, and "not" negates the whole remainder of the query.
+        Keep in sync with Parser.GRAMMAR (tests/test_grammar.py compares both if tatsu is installed).
+    """
+
+    WHITESPACE = re.compile(r"\s*")
+    NUMBER = re.compile(r"[-]?[0-9]+[.]?[0-9]*", re.IGNORECASE)
+    STRING = re.compile(r"[a-zA-Z0-9_\.\-\/\,\:\+\=\@]+", re.IGNORECASE)
+    SINGLEQUOTED = re.compile(r"""[a-zA-Z0-9_\.\-\/\,\:\+\=\@\s"\*\\]+""", re.IGNORECASE)
+    DOUBLEQUOTED = re.compile(r"""[a-zA-Z0-9_\.\-\/\,\:\+\=\@\s'\*\\]+""", re.IGNORECASE)
+    NAME = re.compile(r"[a-zA-Z][a-zA-Z0-9_]*", re.IGNORECASE)
+
+    CONSTRAINT_OPERATORS = [ "=", "!=", "<=", ">=", "<", ">" ]
+    TERM_OPERATORS = [ "+", "-", "*", "/" ]
+
+    class Failure(Exception):
+        pass
+
+    @classmethod
+    def parse(cls, text):
+        return cls(text).start()
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def start(self):
+        text = self.text
+        try:
+            ast = AST(q=self.query())
+            self.skip()
+            if self.pos < len(self.text):
+                raise QueryModel.Failure()
+            return ast
+        except QueryModel.Failure:
+            raise ParserException("Failed to parse query: '{}' at position {}".format(text, self.pos))
+
+    def skip(self):
+        self.pos = QueryModel.WHITESPACE.match(self.text, self.pos).end()
+
+    def token(self, tokens):
+        self.skip()
+        for token in tokens:
+            end = self.pos + len(token)
+            if self.text[self.pos:end].lower() == token:
+                # name guard: alphanumeric tokens must not be followed by a name character
+                if token.isalnum() and end < len(self.text) and (self.text[end].isalnum() or self.text[end] == "_"):
+                    continue
+                self.pos = end
+                return token
+        return None
+
+    def pattern(self, regex):
+        self.skip()
+        match = regex.match(self.text, self.pos)
+        if match:
+            self.pos = match.end()
+            return match.group()
+        return None
+
+    def expect(self, result):
+        if result is None:
+            raise QueryModel.Failure()
+        return result
+
+    def alternatives(self, *rules):
+        start = self.pos
+        for rule in rules:
+            try:
+                return rule()
+            except QueryModel.Failure:
+                self.pos = start
+        raise QueryModel.Failure()
+
+    # query = left:query qop:("and" | "or") ~ right:query | qop:("not") ~ q:query | constraint | "(" q:query ")"
+    def query(self):
+        start = self.pos
+        if self.token([ "not" ]):
+            return AST(qop="not", q=self.query())
+        self.pos = start
+        left = self.alternatives(self.constraint, self.parenthesized_query)
+        start = self.pos
+        qop = self.token([ "and", "or" ])
+        if qop is None:
+            self.pos = start
+            return left
+        return AST(left=left, qop=qop, right=self.query())
+
+    def parenthesized_query(self):
+        self.expect(self.token([ "(" ]))
+        ast = AST(q=self.query())
+        self.expect(self.token([ ")" ]))
+        return ast
+
+    def column(self):
+        start = self.pos
+        dbname = self.pattern(QueryModel.NAME)
+        if dbname is not None and self.token([ ":" ]):
+            column = self.pattern(QueryModel.NAME)
+            if column is not None:
+                return [ dbname, ":", column ]
+        self.pos = start
+        return self.expect(self.pattern(QueryModel.NAME))
+
+    def constraint(self):
+        def with_term():
+            col, cop = self.column(), self.expect(self.token(QueryModel.CONSTRAINT_OPERATORS))
+            self.expect(self.token([ "(" ]))
+            ter = AST(t=self.term())
+            self.expect(self.token([ ")" ]))
+            return AST(col=col, cop=cop, ter=ter)
+        def with_number():
+            col, cop = self.column(), self.expect(self.token(QueryModel.CONSTRAINT_OPERATORS))
+            return AST(col=col, cop=cop, num=self.expect(self.pattern(QueryModel.NUMBER)))
+        def with_string():
+            col, cop = self.column(), self.expect(self.token(QueryModel.CONSTRAINT_OPERATORS))
+            return AST(col=col, cop=cop, str=self.string())
+        def with_like():
+            col, cop = self.column(), self.expect(self.token([ "like", "unlike" ]))
+            prefix = self.token([ "%" ])
+            string = self.string()
+            suffix = self.token([ "%" ])
+            return AST(col=col, cop=cop, lik=[ prefix, string, suffix ])
+        return self.alternatives(with_term, with_number, with_string, with_like)
+
+    # term = left:term top:("+" | "-" | "*" | "/") right:term | "(" t:term ")" | constant:number | col:(dbname ":" column | column)
+    def term(self):
+        def parenthesized_term():
+            self.expect(self.token([ "(" ]))
+            ast = AST(t=self.term())
+            self.expect(self.token([ ")" ]))
+            return ast
+        left = self.alternatives(parenthesized_term, lambda: AST(constant=self.expect(self.pattern(QueryModel.NUMBER))), lambda: AST(col=self.column()))
+        start = self.pos
+        top = self.token(QueryModel.TERM_OPERATORS)
+        if top is not None:
+            try:
+                return AST(left=left, top=top, right=self.term())
+            except QueryModel.Failure:
+                pass
+        self.pos = start
+        return left
+
+    def string(self):
+        start = self.pos
+        for (quote, regex) in [ ("'", QueryModel.SINGLEQUOTED), ('"', QueryModel.DOUBLEQUOTED) ]:
+            if self.token([ quote ]):
+                string = self.pattern(regex)
+                if string is not None and self.token([ quote ]):
+                    return string
+            self.pos = start
+        return self.expect(self.pattern(QueryModel.STRING))
+
 class Parser:
     GRAMMAR = r'''
         @@grammar::GBDQuery
@@ -75,18 +240,28 @@ class Parser:
     '''
 
 
-    model = tatsu.compile(GRAMMAR)
+    model = QueryModel
+
+    # parsed queries by query string
+    cache = LRUCache(maxsize=1024)
+
+
+    @classmethod
+    def parse(cls, query):
+        ast = cls.cache.get(query)
+        if ast is None:
+            ast = cls.model.parse(query)
+            cls.cache.put(query, ast)
+        return ast
 
 
     def __init__(self, query, verbose=False):
         try:
-            self.ast = Parser.model.parse(query) if query else dict()
+            self.ast = Parser.parse(query) if query else dict()
             if verbose:
                 print("Parsed: " + query)
-                print(json.dumps(tatsu.util.asjson(self.ast), indent=2))
-        except tatsu.exceptions.FailedParse as e:
-            raise ParserException("Failed to parse query: {}".format(str(e)))
-        except tatsu.exceptions.FailedLeftRecursion as e:
+                print(json.dumps(self.ast, indent=2))
+        except RecursionError as e:
             raise ParserException("Failed to parse query: {}".format(str(e)))
 
 
@@ -112,6 +287,43 @@ class Parser:
             raise ParserException("Failed to parse query: {}".format(str(e)))
 
 
+    def subquery(self, db: Database, ast):
+        """ Set predicate of a constraint on a 1:n feature
+
+        Args:
+            db (Database): database instance
+            ast (AST): constraint node
+
+        Returns:
+            (table, set operator, condition) such that the constraint reads "table.hash <set operator> (SELECT table.hash FROM table WHERE condition)",
+            None if the constraint is not evaluated as a subquery
+        """
+        if not "cop" in ast or db.find("".join(ast["col"])).default is not None:
+            return None
+        table = db.faddr_table("".join(ast["col"]))
+        feat = db.faddr("".join(ast["col"]))
+        if "str" in ast:
+            return (table, "IN" if ast["cop"] == "=" else "NOT IN", "{} = '{}'".format(feat, ast["str"]))
+        elif "num" in ast:
+            return (table, "IN", self.numeric_constraint(db, ast["col"], ast["cop"], ast["num"]))
+        elif "lik" in ast:
+            return (table, "IN" if ast["cop"] == "like" else "NOT IN", "{} like '{}'".format(feat, "".join([ t for t in ast["lik"] if t ])))
+        elif "ter" in ast and ast["cop"] == "!=":
+            return (table, "NOT IN", self.numeric_constraint(db, ast["col"], "=", self.get_sql(db, ast["ter"])))
+        return None
+
+
+    def numeric_constraint(self, db: Database, col, operator, rhs):
+        # features declared as int or real are compared natively (which allows for using indexes on them),
+        # the type check excludes non-numeric placeholders like 'None'
+        finfo = db.find("".join(col))
+        feat = db.faddr("".join(col))
+        if finfo.is_numeric():
+            return "({f} {o} {r} AND typeof({f}) IN ('integer', 'real'))".format(f=feat, o=operator, r=rhs)
+        else:
+            return "CAST({} AS FLOAT) {} {}".format(feat, operator, rhs)
+
+
     def get_sql(self, db: Database, ast=None):
         try:
             ast = ast if ast else self.ast
@@ -121,43 +333,35 @@ class Parser:
                 return "(" + self.get_sql(db, ast["q"]) + ")"
             elif "t" in ast:
                 return "(" + self.get_sql(db, ast["t"]) + ")"
+            elif "args" in ast: # n-ary query operator (introduced by the optimizer)
+                return "(" + " {} ".format(ast["qop"]).join([ self.get_sql(db, arg) for arg in ast["args"] ]) + ")"
+            elif "semi" in ast: # merged constraints on the same 1:n feature table (introduced by the optimizer)
+                subqueries = [ self.subquery(db, constraint) for constraint in ast["semi"] ]
+                table = subqueries[0][0]
+                if ast["combine"] == "intersect":
+                    select = " INTERSECT ".join([ "SELECT {t}.hash FROM {t} WHERE {c}".format(t=table, c=c) for (_, _, c) in subqueries ])
+                else:
+                    select = "SELECT {t}.hash FROM {t} WHERE ".format(t=table) + " OR ".join([ "({})".format(c) for (_, _, c) in subqueries ])
+                return "{t}.hash {o} ({s})".format(t=table, o=subqueries[0][1], s=select)
             elif "qop" in ast or "top" in ast: # query operator or term operator
                 operator = ast["qop"] if ast["qop"] else ast["top"]
                 left = self.get_sql(db, ast["left"])
                 right = self.get_sql(db, ast["right"])
                 return "{} {} {}".format(left, operator, right)
             elif "cop" in ast: # constraint operator
+                subquery = self.subquery(db, ast)
+                if subquery is not None:
+                    return "{t}.hash {o} (SELECT {t}.hash FROM {t} WHERE {c})".format(t=subquery[0], o=subquery[1], c=subquery[2])
                 operator = "not like" if ast["cop"] == "unlike" else ast["cop"]
                 feat = db.faddr("".join(ast["col"]))
-                feat_is_1_n = db.find("".join(ast["col"])).default is None
                 if "str" in ast: # cop:("=" | "!=")
-                    if feat_is_1_n:
-                        table = db.faddr_table("".join(ast["col"]))
-                        setop = "IN" if ast["cop"] == "=" else "NOT IN"
-                        return "{t}.hash {o} (SELECT {t}.hash FROM {t} WHERE {f} = '{s}')".format(o=setop, t=table, f=feat, s=ast["str"])
-                    else:
-                        return "{} {} '{}'".format(feat, operator, ast["str"])
+                    return "{} {} '{}'".format(feat, operator, ast["str"])
                 elif "num" in ast: # cop:("=" | "!=" | "<=" | ">=" | "<" | ">" )
-                    if feat_is_1_n:
-                        table = db.faddr_table("".join(ast["col"]))
-                        return "{t}.hash IN (SELECT {t}.hash FROM {t} WHERE CAST({f} AS FLOAT) {o} {s})".format(o=operator, t=table, f=feat, s=ast["num"])
-                    else:
-                        return "CAST({} AS FLOAT) {} {}".format(feat, operator, ast["num"])
+                    return self.numeric_constraint(db, ast["col"], operator, ast["num"])
                 elif "lik" in ast: # cop:("like" | "unlike")
-                    if feat_is_1_n:
-                        table = db.faddr_table("".join(ast["col"]))
-                        setop = "IN" if ast["cop"] == "like" else "NOT IN"
-                        return "{t}.hash {o} (SELECT {t}.hash FROM {t} WHERE {f} like '{s}')".format(o=setop, t=table, f=feat, s="".join([ t for t in ast["lik"] if t ]))
-                    else:
-                        return "{} {} '{}'".format(feat, operator, "".join([ t for t in ast["lik"] if t ]))
+                    return "{} {} '{}'".format(feat, operator, "".join([ t for t in ast["lik"] if t ]))
                 elif "ter" in ast: # cop:("=" | "!=" | "<=" | ">=" | "<" | ">" )
-                    if feat_is_1_n and ast["cop"] == "!=":
-                        table = db.faddr_table("".join(ast["col"]))
-                        setop = "NOT IN" if ast["cop"] == "!=" else "IN"
-                        cop = "=" if ast["cop"] == "!=" else ast["cop"]
-                        return "{t}.hash {o} (SELECT {t}.hash FROM {t} WHERE CAST({f} AS FLOAT) {c} {s})".format(o=setop, c=cop, t=table, f=feat, s=self.get_sql(db, ast["ter"]))
-                    else:
-                        return "CAST({} AS FLOAT) {} {}".format(feat, operator, self.get_sql(db, ast["ter"]))
+                    return self.numeric_constraint(db, ast["col"], operator, self.get_sql(db, ast["ter"]))
                 raise ParserException("Missing right-hand side of constraint")
             elif "col" in ast:
                 feature = db.faddr("".join(ast["col"]))
@@ -0,0 +1,109 @@
+
+# MIT License
+
+# Copyright (c) 2023 Markus Iser, Karlsruhe Institute of Technology (KIT)
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+
+from gbd_core.database import Database
+from gbd_core.grammar import AST, Parser
+
+
+class QueryOptimizer:
+    """ Rewrites the parse tree of a GBD query before SQL generation
+
+        And/or chains are normalized into n-ary nodes with SQL operator precedence (which is how their generated SQL is evaluated).
+        Constraints on the same 1:n feature table which are combined by the same operator are then merged into one subquery:
+
+        - t IN (A) OR t IN (B) becomes t IN (A OR B)
+        - t NOT IN (A) AND t NOT IN (B) becomes t NOT IN (A OR B)
+        - t IN (A) AND t IN (B) becomes t IN (A INTERSECT B), only outside of negations,
+          as the rewrite turns NULL (no value joined) into FALSE
+    """
+
+    def __init__(self, db: Database, parser: Parser):
+        self.db = db
+        self.parser = parser
+
+
+    def optimize(self, ast=None):
+        ast = ast if ast is not None else self.parser.ast
+        if not ast:
+            return ast
+        return self.rewrite(ast, True)
+
+
+    def rewrite(self, ast, positive):
+        if "qop" in ast and ast["qop"] == "not":
+            return AST(qop="not", q=self.rewrite(ast["q"], not positive))
+        elif "q" in ast:
+            return self.rewrite(ast["q"], positive)
+        elif "qop" in ast:
+            return self.rewrite_chain(self.normalize(ast), positive)
+        return ast
+
+
+    def normalize(self, ast):
+        # flatten right-nested chain, and binds tighter than or
+        terms = [ ]
+        while "qop" in ast and ast["qop"] in [ "and", "or" ]:
+            terms.append(ast["left"])
+            terms.append(ast["qop"])
+            ast = ast["right"]
+        terms.append(ast)
+        disjuncts = [ [ terms[0] ] ]
+        for i in range(1, len(terms), 2):
+            if terms[i] == "or":
+                disjuncts.append([ ])
+            disjuncts[-1].append(terms[i+1])
+        conjunctions = [ AST(qop="and", args=c) if len(c) > 1 else c[0] for c in disjuncts ]
+        return AST(qop="or", args=conjunctions) if len(conjunctions) > 1 else conjunctions[0]
+
+
+    def rewrite_chain(self, ast, positive):
+        if not "args" in ast:
+            return self.rewrite(ast, positive)
+        args = [ ]
+        for arg in [ self.rewrite_chain(arg, positive) for arg in ast["args"] ]:
+            if "args" in arg and arg["qop"] == ast["qop"]:
+                args.extend(arg["args"])
+            else:
+                args.append(arg)
+        args = self.merge(ast["qop"], args, positive)
+        return AST(qop=ast["qop"], args=args) if len(args) > 1 else args[0]
+
+
+    def merge(self, qop, args, positive):
+        groups = dict()
+        for arg in args:
+            key = self.merge_key(qop, arg, positive)
+            if key is not None:
+                groups.setdefault(key, [ ]).append(arg)
+        result = [ ]
+        for arg in args:
+            key = self.merge_key(qop, arg, positive)
+            if key is None or len(groups[key]) == 1:
+                result.append(arg)
+            elif groups[key][0] is arg:
+                combine = "intersect" if qop == "and" and key[1] == "IN" else "or"
+                result.append(AST(semi=groups[key], combine=combine))
+        return result
+
+
+    def merge_key(self, qop, arg, positive):
+        subquery = self.parser.subquery(self.db, arg)
+        if subquery is None:
+            return None
+        (table, setop, _) = subquery
+        if qop == "or" and setop == "IN" or qop == "and" and setop == "NOT IN" or qop == "and" and positive:
+            return (table, setop)
+        return None
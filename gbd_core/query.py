@@ -16,13 +16,22 @@
 
 from gbd_core.database import Database, DatabaseException
 from gbd_core.grammar import Parser
+from gbd_core.optimizer import QueryOptimizer
 from gbd_core import contexts
 from gbd_core.schema import Schema
+from gbd_core.cache import LRUCache
 
 class GBDQuery:
 
+    # generated sql (without hash restriction) by query, build parameters and database schema
+    cache = LRUCache(maxsize=1024)
+
+    # rewrite parse tree and drop redundant DISTINCT before SQL generation (see QueryOptimizer)
+    optimize = True
+
     def __init__(self, db: Database, query):
         self.db = db
+        self.query = query
         self.parser = Parser(query)
         self.features = self.parser.get_features()
 
@@ -34,6 +43,20 @@ class GBDQuery:
 
     # Generate SQL Query from given GBD Query 
     def build_query(self, hashes=[], resolve=[], group_by=None, join_type="LEFT", collapse=None):
+        key = (self.query, tuple(resolve), group_by, join_type, collapse, GBDQuery.optimize, self.db.schema_version())
+        parts = GBDQuery.cache.get(key)
+        if parts is None:
+            parts = self.build_parts(resolve, group_by, join_type, collapse)
+            GBDQuery.cache.put(key, parts)
+
+        (group, sql_select, sql_from, sql_where, sql_groupby, sql_orderby) = parts
+        if len(hashes):
+            sql_where = sql_where + " AND " + self.build_hash_restriction(hashes, group)
+
+        return "{} {} WHERE {} {} {}".format(sql_select, sql_from, sql_where, sql_groupby, sql_orderby)
+
+
+    def build_parts(self, resolve=[], group_by=None, join_type="LEFT", collapse=None):
         group = group_by or self.determine_group_by(resolve)
 
         self.features_exist_or_throw(resolve + [group] + list(self.features))
@@ -42,12 +65,12 @@ class GBDQuery:
 
         sql_from = self.build_from(group, set(resolve) | self.features, join_type)
         
-        sql_where = self.build_where(hashes, group)
+        sql_where = self.build_where([], group)
 
         sql_groupby = "GROUP BY {}".format(self.db.faddr(group)) if collapse else ""
         sql_orderby = "ORDER BY {}".format(self.db.faddr(group))
-        
-        return "{} {} WHERE {} {} {}".format(sql_select, sql_from, sql_where, sql_groupby, sql_orderby)
+
+        return (group, sql_select, sql_from, sql_where, sql_groupby, sql_orderby)
     
 
     def determine_group_by(self, resolve):
@@ -61,6 +84,8 @@ class GBDQuery:
         result = [ self.db.faddr(f) for f in [group_by] + resolve ]
         if collapse and collapse != "none":
             result = [ "{}(DISTINCT {})".format(collapse, r) for r in result ]
+        if collapse and GBDQuery.optimize: # rows are already unique by GROUP BY
+            return "SELECT " + ", ".join(result)
         return "SELECT DISTINCT " + ", ".join(result)
 
 
@@ -116,8 +141,13 @@ class GBDQuery:
 
     def build_where(self, hashes, group_by):
         group_column = self.db.faddr(group_by)
-        group_table = self.db.faddr_table(group_by)
-        result = group_column + " != 'None' AND " + self.parser.get_sql(self.db)
+        ast = QueryOptimizer(self.db, self.parser).optimize() if GBDQuery.optimize else self.parser.ast
+        result = group_column + " != 'None' AND (" + self.parser.get_sql(self.db, ast) + ")"
         if len(hashes):
-            result = result + " AND {}.hash in ('{}')".format(group_table, "', '".join(hashes))
+            result = result + " AND " + self.build_hash_restriction(hashes, group_by)
         return result
+
+
+    def build_hash_restriction(self, hashes, group_by):
+        group_table = self.db.faddr_table(group_by)
+        return self.db.hash_restriction(group_table + ".hash", hashes)
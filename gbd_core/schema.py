@@ -18,11 +18,31 @@ import typing
 import os
 import csv
 import re
+import json
+import hashlib
 
 from dataclasses import dataclass
+from contextlib import closing, nullcontext
 
-from gbd_core import contexts
-from gbd_core.util import eprint, confirm
+from gbd_core import contexts, util
+from gbd_core.util import eprint, confirm, slice_iterator
+
+
+# number of rows per executemany call in bulk writes
+BATCH_SIZE = 10000
+
+# declared feature types and the column types they are stored with, the latter determine sqlite's type affinity
+DATATYPES = { "text": "TEXT", "int": "INTEGER", "real": "REAL", "category": "CATEGORY TEXT" }
+NUMERIC_DATATYPES = [ "int", "real" ]
+
+# format version of compiled CSV files, cached files of other versions are rebuilt
+CSV_CACHE_VERSION = 1
+
+# format version of cached schema metadata of databases, cached metadata of other versions is rebuilt
+SCHEMA_CACHE_VERSION = 2
+
+# cached schema metadata is pruned when there are more files than this in the cache directory
+SCHEMA_CACHE_ENTRIES = 1000
 
 
 class SchemaException(Exception):
@@ -36,16 +56,20 @@ class FeatureInfo:
     table: str = None
     column: str = None
     default: str = None
+    datatype: str = "text"
+
+    def is_numeric(self):
+        return self.datatype in NUMERIC_DATATYPES
 
 
 class Schema:
 
-    def __init__(self, dbcon, dbname, path, features, context, csv=False):
+    def __init__(self, pool, dbname, path, features, context, csv=False):
         self.dbname = dbname
         self.path = path
         self.features = features
         self.context = context
-        self.dbcon = dbcon
+        self.pool = pool
         self.csv = csv
 
     @classmethod
@@ -62,70 +86,214 @@ class Schema:
         else:
             raise SchemaException("Database '{}' does not exist".format(path))
 
+    # pool: connection pool (see gbd_core.database.ConnectionPool) which serves the schema's connections
     @classmethod
-    def create(cls, path):
+    def create(cls, path, pool):
         try:
             if cls.is_database(path):
-                return cls.from_database(path)
+                return cls.from_database(path, pool)
             else:
-                return cls.from_csv(path)
+                return cls.from_csv(path, pool)
         except Exception as e:
             raise SchemaException(str(e))
 
     @classmethod
-    def from_database(cls, path):
+    def from_database(cls, path, pool):
         dbname = cls.dbname_from_path(path)
-        con = sqlite3.connect(path)
+        con = pool.get(path)
         features = cls.features_from_database(dbname, path, con)
         context = cls.context_from_database(dbname)
-        return cls(con, dbname, path, features, context)
+        return cls(pool, dbname, path, features, context)
 
     @classmethod
-    def from_csv(cls, path):
+    def from_csv(cls, path, pool):
         dbname = cls.dbname_from_path(path)
-        con = sqlite3.connect("file:{}?mode=memory&cache=shared".format(dbname), uri=True)
+        # the pooled connection keeps the shared in-memory database alive
+        con = pool.get(cls.memory_uri(dbname))
         features = cls.features_from_csv(dbname, path, con)
         context = cls.context_from_csv(dbname)
-        return cls(con, dbname, path, features, context, True)
+        return cls(pool, dbname, path, features, context, True)
+
+    @classmethod
+    def memory_uri(cls, dbname):
+        return "file:{}?mode=memory&cache=shared".format(dbname)
 
     # Import CSV to in-memory db, create according schema info
+    # The CSV is compiled once into a sqlite file in the cache directory which is reused as long as the CSV does not change
     @classmethod
     def features_from_csv(cls, dbname, path, con) -> typing.Dict[str, FeatureInfo]:
-        features = dict()
-        with open(path) as csvfile:
+        try:
+            cache = cls.compile_csv(path)
+        except OSError as e:
+            eprint("Failed to cache '{}' ({}), importing directly".format(path, str(e)))
+            cache = None
+        if cache is None:
+            cols = cls.import_csv(path, con)
+        elif not "features" in [ tab for (tab, ) in con.execute("SELECT tbl_name FROM sqlite_master WHERE type = 'table'") ]:
+            with closing(sqlite3.connect(cache)) as source:
+                source.backup(con)
+                cols = [ col for (_, col, _, _, _, _) in source.execute("PRAGMA table_info(features)") ]
+        else:  # another CSV with the same name was loaded before
+            con.execute("ATTACH DATABASE '{}' AS csv_cache".format(cache))
+            try:
+                cols = [ col for (_, col, _, _, _, _) in con.execute("PRAGMA csv_cache.table_info(features)") ]
+                con.execute("INSERT INTO features SELECT * FROM csv_cache.features")
+                con.commit()
+            finally:
+                con.execute("DETACH DATABASE csv_cache")
+        return { colname: FeatureInfo(colname, dbname, "features", colname, None) for colname in cols }
+
+    @classmethod
+    def compile_csv(cls, path):
+        """ Get sqlite cache file of CSV, (re-)compile it if the CSV is new or changed (by path, size and mtime) """
+        stat = os.stat(path)
+        source = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, CSV_CACHE_VERSION)
+        cache = os.path.join(util.cache_dir("csv"), hashlib.sha1(source[0].encode("utf-8")).hexdigest() + ".db")
+        if os.path.isfile(cache):
+            try:
+                with closing(sqlite3.connect(cache)) as con:
+                    if con.execute("SELECT path, size, mtime_ns, version FROM _source").fetchone() == source:
+                        return cache
+            except sqlite3.DatabaseError:
+                pass  # incomplete or outdated cache file
+        tmpname = "{}.{}.tmp".format(cache, os.getpid())
+        try:
+            with closing(sqlite3.connect(tmpname)) as con:
+                cls.import_csv(path, con)
+                con.execute("CREATE TABLE _source (path, size, mtime_ns, version)")
+                con.execute("INSERT INTO _source VALUES (?, ?, ?, ?)", source)
+                con.commit()
+            os.replace(tmpname, cache)
+        finally:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+        return cache
+
+    @classmethod
+    def import_csv(cls, path, con):
+        """ Import CSV into features table of given connection, returns the column names """
+        with open(path, newline='') as csvfile:
             temp_lines = csvfile.readline() + '\n' + csvfile.readline()
             dialect = csv.Sniffer().sniff(temp_lines, delimiters=";, \t")
             csvfile.seek(0)
-            csvreader = csv.DictReader(csvfile, dialect=dialect)
-            if "hash" in csvreader.fieldnames:
-                cols = [ re.sub('[^0-9a-zA-Z]+', '_', n) for n in csvreader.fieldnames ]
-                for colname in cols:
-                    features[colname] = FeatureInfo(colname, dbname, "features", colname, None)
+            csvreader = csv.reader(csvfile, dialect=dialect)
+            fieldnames = next(csvreader, [])
+            if not "hash" in fieldnames:
+                raise SchemaException("Column 'hash' not found in {}".format(path))
+            cols = [ re.sub('[^0-9a-zA-Z]+', '_', n) for n in fieldnames ]
+            sql_insert = "INSERT INTO features VALUES ({})".format(", ".join("?" for _ in cols))
+            with con:
                 con.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format("features", ", ".join(cols)))
-                for row in csvreader:
-                    con.execute("INSERT INTO {} VALUES ('{}')".format("features", "', '".join(row.values())))
-                con.commit()
-            else:
-                raise SchemaException("Column 'hash' not found in {}".format(csvfile))
-        return features
+                for batch in slice_iterator((row for row in csvreader if row), BATCH_SIZE):
+                    con.executemany(sql_insert, batch)
+                con.execute("CREATE INDEX IF NOT EXISTS features_hash_idx ON features (hash)")
+        return cols
 
     # Create schema info for sqlite database
+    # The schema info is cached in the cache directory as long as schema_version and table definitions of the database do not change
     @classmethod
     def features_from_database(cls, dbname, path, con) -> typing.Dict[str, FeatureInfo]:
+        (version, ) = con.execute("PRAGMA schema_version").fetchone()
+        # schema_version alone does not tell apart a database which was recreated under the same path
+        digest = hashlib.sha1(repr(con.execute("SELECT name, sql FROM sqlite_master").fetchall()).encode("utf-8")).hexdigest()
+        source = [ os.path.abspath(path), version, digest, SCHEMA_CACHE_VERSION ]
+        try:
+            cache = os.path.join(util.cache_dir("schema"), hashlib.sha1(source[0].encode("utf-8")).hexdigest() + ".json")
+        except OSError:
+            return cls.introspect_database(dbname, con)
+        try:
+            with open(cache) as f:
+                cached = json.load(f)
+            if cached["source"] == source:
+                os.utime(cache)  # mark as recently used
+                return { name: FeatureInfo(name, dbname, table, column, default, datatype) for (name, table, column, default, datatype) in cached["features"] }
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # missing, incomplete or outdated cache file
+        features = cls.introspect_database(dbname, con)
+        tmpname = "{}.{}.tmp".format(cache, os.getpid())
+        try:
+            with open(tmpname, "w") as f:
+                rows = [ (info.name, info.table, info.column, info.default, info.datatype) for info in features.values() ]
+                json.dump({ "source": source, "features": rows }, f)
+            os.replace(tmpname, cache)
+            cls.prune_schema_cache(os.path.dirname(cache))
+        except OSError:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+        return features
+
+    # Remove cached schema metadata of databases which no longer exist if there are more than maxentries files,
+    # and then least recently used ones until half of maxentries remain
+    @classmethod
+    def prune_schema_cache(cls, cachedir, maxentries=SCHEMA_CACHE_ENTRIES):
+        entries = [ entry for entry in os.scandir(cachedir) if entry.name.endswith(".json") ]
+        if len(entries) <= maxentries:
+            return
+        stale, remaining = [ ], [ ]
+        for entry in entries:
+            try:
+                with open(entry.path) as f:
+                    path = json.load(f)["source"][0]
+                if os.path.exists(path):
+                    remaining.append((entry.stat().st_mtime_ns, entry.path))
+                    continue
+            except (OSError, ValueError, KeyError, TypeError, IndexError):
+                pass  # unreadable cache file
+            stale.append(entry.path)
+        evicted = [ cachefile for (_, cachefile) in sorted(remaining)[:max(0, len(remaining) - maxentries // 2)] ]
+        for cachefile in stale + evicted:
+            try:
+                os.remove(cachefile)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def introspect_database(cls, dbname, con) -> typing.Dict[str, FeatureInfo]:
         features = dict()
-        sql_tables="SELECT tbl_name FROM sqlite_master WHERE type = 'table'"
-        tables = [ tab for (tab, ) in con.execute(sql_tables).fetchall() if not tab.startswith("_") ]
-        for table in tables:
-            columns = con.execute("PRAGMA table_info({})".format(table)).fetchall()
-            for (index, colname, coltype, notnull, default_value, pk) in columns:
-                is_fk_column = table == "features" and colname in tables
-                is_fk_hash = table != "features" and colname == "hash"
-                if not is_fk_column and not is_fk_hash:
-                    fname = colname if table == "features" else table
-                    dval = default_value.strip('"') if default_value else None
-                    features[fname] = FeatureInfo(fname, dbname, table, colname, dval)
+        sql_columns = """SELECT m.name, p.name, p.type, p.dflt_value FROM sqlite_master m JOIN pragma_table_info(m.name) p
+                            WHERE m.type = 'table' AND substr(m.name, 1, 1) != '_' AND m.name NOT LIKE 'sqlite\\_%' ESCAPE '\\'
+                            ORDER BY m.rowid, p.cid"""
+        columns = con.execute(sql_columns).fetchall()
+        tables = set([ table for (table, _, _, _) in columns ])
+        for (table, colname, coltype, default_value) in columns:
+            is_fk_column = table == "features" and colname in tables
+            is_fk_hash = table != "features" and colname == "hash"
+            if not is_fk_column and not is_fk_hash:
+                fname = colname if table == "features" else table
+                dval = Schema.value_from_sql_literal(default_value) if default_value else None
+                features[fname] = FeatureInfo(fname, dbname, table, colname, dval, Schema.datatype_from_column_type(coltype))
         return features
 
+    # default values of text columns are quoted literals, identifiers (e.g. None in older databases) are taken as text as well
+    @classmethod
+    def sql_literal(cls, value, datatype="text"):
+        if datatype in NUMERIC_DATATYPES and util.is_number(value):
+            return str(value)
+        return "'{}'".format(str(value).replace("'", "''"))
+
+    @classmethod
+    def value_from_sql_literal(cls, literal):
+        if len(literal) > 1 and literal[0] == literal[-1] and literal[0] in "'\"":
+            return literal[1:-1].replace(literal[0] * 2, literal[0])
+        return literal
+
+    @classmethod
+    def datatype_from_column_type(cls, coltype):
+        for (datatype, decltype) in DATATYPES.items():
+            if coltype.upper() == decltype:
+                return datatype
+        return "text"
+
+    @classmethod
+    def valid_value_or_raise(cls, datatype, value):
+        if datatype in NUMERIC_DATATYPES and value is not None and value != "None":
+            try:
+                number = float(value)
+            except (ValueError, TypeError):
+                number = None
+            if number is None or datatype == "int" and not number.is_integer():
+                raise SchemaException("Value '{}' is not of type {}".format(value, datatype))
+
     @classmethod
     def context_from_csv(cls, path):
         return cls.context_from_name(Schema.dbname_from_path(path))
@@ -177,16 +345,14 @@ class Schema:
 
     def get_connection(self):
         if self.is_in_memory():
-            return sqlite3.connect("file::memory:?cache=shared", uri=True)
+            return self.pool.get(Schema.memory_uri(self.dbname))
         else:
-            return sqlite3.connect(self.path)
+            return self.pool.get(self.path)
 
     def execute(self, sql):
         con = self.get_connection()
-        cur = con.cursor()
-        cur.execute(sql)
+        con.execute(sql)
         con.commit()
-        con.close()
 
 
     def get_tables(self):
@@ -220,9 +386,15 @@ class Schema:
             return [ ]
 
 
-    def create_feature(self, name, default_value=None, permissive=False):
+    def create_feature(self, name, default_value=None, permissive=False, index=False, datatype="text"):
         if not permissive:  # internal use can be unchecked, e.g., to create the reserved features during initialization
             Schema.valid_feature_or_raise(name)
+        if not datatype in DATATYPES:
+            raise SchemaException("Unknown datatype '{}', choose from {}".format(datatype, ", ".join(DATATYPES.keys())))
+        if default_value == "":
+            default_value = "None"
+        Schema.valid_value_or_raise(datatype, default_value)
+        coltype = DATATYPES[datatype]
 
         created = [ ]
         
@@ -232,17 +404,21 @@ class Schema:
 
             # create new feature:
             main_table = "features"
-            self.execute('ALTER TABLE {} ADD {} TEXT NOT NULL DEFAULT {}'.format(main_table, name, default_value or "None"))
             if default_value is not None:
                 # feature is unique and resides in main features-table:
-                self.features[name] = FeatureInfo(name, self.dbname, main_table, name, default_value)
+                self.execute('ALTER TABLE {} ADD {} {} NOT NULL DEFAULT {}'.format(main_table, name, coltype, Schema.sql_literal(default_value, datatype)))
+                self.features[name] = FeatureInfo(name, self.dbname, main_table, name, default_value, datatype)
             else:
                 # feature is not unique and resides in a separate table (column in main features-table is a foreign key):
-                self.execute("CREATE TABLE IF NOT EXISTS {} (hash TEXT NOT NULL, value TEXT NOT NULL, CONSTRAINT all_unique UNIQUE(hash, value))".format(name))
+                self.execute('ALTER TABLE {} ADD {} TEXT NOT NULL DEFAULT None'.format(main_table, name))
+                self.execute("CREATE TABLE IF NOT EXISTS {} (hash TEXT NOT NULL, value {} NOT NULL, CONSTRAINT all_unique UNIQUE(hash, value))".format(name, coltype))
                 self.execute("INSERT INTO {} (hash, value) VALUES ('None', 'None')".format(name))
                 self.execute("""CREATE TRIGGER IF NOT EXISTS {}_hash AFTER INSERT ON {}
                                     BEGIN INSERT OR IGNORE INTO {} (hash) VALUES (NEW.hash); END""".format(name, name, main_table))
-                self.features[name] = FeatureInfo(name, self.dbname, name, "value", None)
+                self.features[name] = FeatureInfo(name, self.dbname, name, "value", None, datatype)
+
+            if index:
+                self.create_index(name)
 
             # update schema:
             created.append(self.features[name])
@@ -253,17 +429,121 @@ class Schema:
         return created
 
 
+    def get_indexes(self):
+        """ List explicitly created indexes (excludes sqlite's autoindexes)
+
+            Returns: list of (index name, feature name) tuples
+            where the feature name is derived from the first indexed column
+        """
+        sql = """SELECT m.name, m.tbl_name, i.name FROM sqlite_master m JOIN pragma_index_info(m.name) i
+                    WHERE m.type = 'index' AND m.sql IS NOT NULL AND i.seqno = 0"""
+        rows = self.get_connection().execute(sql).fetchall()
+        return [ (index, column if table == "features" else table) for (index, table, column) in rows ]
+
+    def create_index(self, feature):
+        """ Create covering index for lookups by feature value:
+            (value, hash) on 1:n tables and (column, hash) on the features table
+        """
+        if not self.has_feature(feature):
+            raise SchemaException("Feature '{}' does not exist".format(feature))
+        if feature in [ f for (_, f) in self.get_indexes() ]:
+            return
+        finfo = self.features[feature]
+        self.execute("CREATE INDEX IF NOT EXISTS {t}_{c}_idx ON {t} ({c}, hash)".format(t=finfo.table, c=finfo.column))
+
+    def drop_index(self, feature):
+        for (index, fname) in self.get_indexes():
+            if fname == feature:
+                self.execute("DROP INDEX IF EXISTS {}".format(index))
+
+
     def set_values(self, feature, value, hashes):
         if not self.has_feature(feature):
             raise SchemaException("Feature '{}' does not exist".format(feature))
         if not len(hashes):
             raise SchemaException("No hashes given")
+        self.set_values_bulk(feature, [ (hash, value) for hash in hashes ])
+
+
+    def set_values_bulk(self, feature, pairs, batch_size=None, commit=True):
+        """ Set feature values for many hashes in a single transaction
+
+            Args:
+            feature (str): feature name
+            pairs (iterable): (hash, value) tuples, may be a generator
+            batch_size (int): number of rows handed to executemany at once (default: BATCH_SIZE)
+            commit (bool): if False, the transaction is left open for the caller to commit (or roll back) together with further writes
+        """
+        if not self.has_feature(feature):
+            raise SchemaException("Feature '{}' does not exist".format(feature))
         table = self.features[feature].table
         column = self.features[feature].column
-        values = ', '.join(["('{}', '{}')".format(hash, value) for hash in hashes])
+        datatype = self.features[feature].datatype
         if self.features[feature].default is None:
-            self.execute("INSERT OR IGNORE INTO {tab} (hash, {col}) VALUES {vals}".format(tab=table, col=column, vals=values))
-            self.execute("UPDATE features SET {col}=hash WHERE hash in ('{h}')".format(col=table, h="', '".join(hashes)))
+            sql_insert = "INSERT OR IGNORE INTO {tab} (hash, {col}) VALUES (?, ?)".format(tab=table, col=column)
+            sql_update = "UPDATE features SET {tab}=hash WHERE hash=?".format(tab=table)
         else:
-            self.execute("INSERT INTO {tab} (hash, {col}) VALUES {vals} ON CONFLICT (hash) DO UPDATE SET {col}='{val}' WHERE hash in ('{h}')".format(tab=table, col=column, val=value, vals=values, h="', '".join(hashes)))
+            sql_insert = "INSERT INTO {tab} (hash, {col}) VALUES (?, ?) ON CONFLICT (hash) DO UPDATE SET {col}=excluded.{col}".format(tab=table, col=column)
+            sql_update = None
+        con = self.get_connection()
+        with con if commit else nullcontext(con):
+            for batch in slice_iterator(pairs, batch_size or BATCH_SIZE):
+                rows = [ (hash, "None" if value is None else value) for (hash, value) in batch ]
+                if datatype in NUMERIC_DATATYPES:
+                    for (_, value) in rows:
+                        Schema.valid_value_or_raise(datatype, value)
+                con.executemany(sql_insert, rows)
+                if sql_update:
+                    con.executemany(sql_update, [ (hash, ) for hash in set(hash for (hash, _) in rows) ])
+
+
+    @classmethod
+    def fill_temp_table(cls, con, name, column, items):
+        """ (Re-)create temporary table with one column and load the given items into it """
+        con.execute("DROP TABLE IF EXISTS temp.{}".format(name))
+        con.execute("CREATE TEMP TABLE {} ({} PRIMARY KEY) WITHOUT ROWID".format(name, column))
+        for batch in slice_iterator(items, BATCH_SIZE):
+            con.executemany("INSERT OR IGNORE INTO temp.{} VALUES (?)".format(name), [ (item, ) for item in batch ])
+
+
+    def delete_values(self, feature, values=[], hashes=[]):
+        """ Reset feature values in a single transaction, restricted to the given values and/or hashes
 
+            Values of 1:1 features are reset to the default value,
+            values of 1:n features are deleted (features without any remaining value point to 'None')
+        """
+        if not self.has_feature(feature):
+            raise SchemaException("Feature '{}' does not exist".format(feature))
+        if not len(values) and not len(hashes):
+            return
+        finfo = self.features[feature]
+        where = [ "{t}.hash != 'None'".format(t=finfo.table) ]
+        if len(values):
+            where.append("EXISTS (SELECT 1 FROM temp._gbd_values v WHERE v.value = {t}.{c})".format(t=finfo.table, c=finfo.column))
+        if len(hashes):
+            where.append("EXISTS (SELECT 1 FROM temp._gbd_hashes h WHERE h.hash = {t}.hash)".format(t=finfo.table))
+        where = " AND ".join(where)
+        con = self.get_connection()
+        with con:
+            Schema.fill_temp_table(con, "_gbd_values", "value", values)
+            Schema.fill_temp_table(con, "_gbd_hashes", "hash", hashes)
+            if finfo.default is None:
+                con.execute("CREATE TEMP TABLE _gbd_affected AS SELECT DISTINCT hash FROM {t} WHERE {w}".format(t=finfo.table, w=where))
+                con.execute("DELETE FROM {t} WHERE {w}".format(t=finfo.table, w=where))
+                con.execute("""UPDATE features SET {t} = 'None' WHERE hash IN (SELECT hash FROM temp._gbd_affected)
+                                AND NOT EXISTS (SELECT 1 FROM {t} WHERE {t}.hash = features.hash)""".format(t=finfo.table))
+                con.execute("DROP TABLE temp._gbd_affected")
+            else:
+                con.execute("UPDATE features SET {c} = ? WHERE {w}".format(c=finfo.column, w=where), (finfo.default, ))
+            con.execute("DROP TABLE temp._gbd_values")
+            con.execute("DROP TABLE temp._gbd_hashes")
+
+
+    def delete_hashes(self, hashes):
+        """ Delete all values of the given hashes from all tables in a single transaction """
+        con = self.get_connection()
+        with con:
+            Schema.fill_temp_table(con, "_gbd_hashes", "hash", hashes)
+            for table in self.get_tables():
+                con.execute("DELETE FROM {t} WHERE EXISTS (SELECT 1 FROM temp._gbd_hashes h WHERE h.hash = {t}.hash)".format(t=table))
+            con.execute("DROP TABLE temp._gbd_hashes")
@@ -76,6 +76,59 @@ def is_number(s):
     return False
 
 
+def cache_dir(*subdirs):
+    """ Directory for persistent caches: $GBD_CACHE, else $XDG_CACHE_HOME/gbd, else ~/.cache/gbd """
+    base = os.environ.get('GBD_CACHE') or os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache"), "gbd")
+    path = os.path.join(base, *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def scan_files(root, suffixes, threads=16):
+    """ Recursively find files below root whose names end with one of the given suffixes
+
+        Walks the tree once for all suffixes. Directories are listed by a pool of threads, which hides latencies on network filesystems.
+        Like glob, hidden files and directories (leading dot) are skipped and symbolic links are followed.
+
+        Returns: generator of paths in no particular order
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    suffixes = tuple(suffixes)
+
+    def listdir(path):
+        files, dirs, links = [ ], [ ], [ ]
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            (links if entry.is_symlink() else dirs).append(entry.path)
+                        elif entry.name.endswith(suffixes) and entry.is_file():
+                            files.append(entry.path)
+                    except OSError:
+                        pass
+        except OSError as e:
+            eprint("{}: {}".format(e.__class__.__name__, e))
+        # symbolic links to directories are followed once per target, which also breaks cycles
+        return files, dirs, [ (link, os.path.realpath(link)) for link in links ]
+
+    visited = { os.path.realpath(root) }
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = { pool.submit(listdir, root) }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs, links = future.result()
+                yield from files
+                for (link, target) in links:
+                    if not target in visited:
+                        visited.add(target)
+                        dirs.append(link)
+                pending.update([ pool.submit(listdir, path) for path in dirs ])
+
+
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
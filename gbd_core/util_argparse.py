@@ -21,6 +21,10 @@ def get_gbd_argparser():
     parser = argparse.ArgumentParser(description='GBD Benchmark Database')
     parser.add_argument('-d', "--db", type=gbd_db_type, default=os.environ.get('GBD_DB'), help='Specify database to work with')
     parser.add_argument('-v', '--verbose', action='store_true', help='Print additional (or diagnostic) information to stderr')
+    parser.add_argument('--journal', choices=['default', 'wal'], default=os.environ.get('GBD_JOURNAL') or 'default', 
+                        help='Journaling profile: wal switches databases to write-ahead logging (persistent), such that readers are not blocked by writers')
+    parser.add_argument('--busy-timeout', type=float, default=os.environ.get('GBD_BUSY_TIMEOUT') or 10, help='Seconds to wait for locked databases')
+    parser.add_argument('--autocheckpoint', type=int, default=None, help='Checkpoint write-ahead log when it exceeds the given number of pages (default: 1000)')
     return parser
 
 def add_query_and_hashes_arguments(parser: argparse.ArgumentParser):
@@ -32,6 +36,7 @@ def add_resource_limits_arguments(parser: argparse.ArgumentParser):
     parser.add_argument('-t', '--tlim', default=5000, type=int, help="Time limit (sec) per instance for 'init' sub-commands (also used for score calculation in 'eval' and 'plot')")
     parser.add_argument('-m', '--mlim', default=2000, type=int, help="Memory limit (MB) per instance for 'init' sub-commands")
     parser.add_argument('-f', '--flim', default=1000, type=int, help="File size limit (MB) per instance for 'init' sub-commands which create files")
+    parser.add_argument('--worker-tasks', default=0, type=int, help="Instances per worker process in parallel runs before it is replaced (0: reuse workers until they exceed a limit, 1: new process per instance)")
 
 
 ### Argument Types for Input Sanitation in ArgParse Library
@@ -0,0 +1,54 @@
+
+# MIT License
+
+# Copyright (c) 2023 Markus Iser, Karlsruhe Institute of Technology (KIT)
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# Metadata of the generic feature extractors and instance transformers.
+# Kept separate from their implementations such that the command-line interface 
+# can be set up without importing pandas, pebble and the multiprocessing machinery.
+
+extractors = {
+    "base" : {
+        "description" : "Extract base features from CNF files. ",
+        "contexts" : [ "cnf" ],
+    },
+    "gate" : {
+        "description" : "Extract gate features from CNF files. ",
+        "contexts" : [ "cnf" ],
+    },
+    "isohash" : {
+        "description" : "Compute ISOHash for CNF or WCNF files. ",
+        "contexts" : [ "cnf", "wcnf" ],
+    },
+    "wcnfbase" : {
+        "description" : "Extract base features from WCNF files. ",
+        "contexts" : [ "wcnf" ],
+    },
+    "opbbase" : {
+        "description" : "Extract base features from OPB files. ",
+        "contexts" : [ "opb" ],
+    },
+}
+
+transformers = {
+    "sanitize" : {
+        "description" : "Sanitize CNF files. ",
+        "source" : [ "cnf" ],
+        "target" : [ "sancnf" ],
+    },
+    "cnf2kis" : {
+        "description" : "Transform CNF files to k-ISP instances. ",
+        "source" : [ "cnf" ],
+        "target" : [ "kis" ],
+    },
+}
@@ -15,14 +15,15 @@
 
 import pandas as pd
 import os
-import glob
 import warnings
 from multiprocessing import Value
+from concurrent.futures import ThreadPoolExecutor
 
 from gbd_core.contexts import suffixes, identify, get_context_by_suffix
 from gbd_core.api import GBD, GBDException
-from gbd_core.util import eprint, confirm
+from gbd_core.util import eprint, confirm, scan_files
 from gbd_init.initializer import Initializer, InitializerException
+from gbd_init import catalog
 
 gbdc_available = True
 try:
@@ -125,46 +126,41 @@ def compute_opb_base_features(hash, path, limits, tp=None):
 
 generic_extractors = {
     "base" : {
-        "description" : "Extract base features from CNF files. ",
-        "contexts" : [ "cnf" ],
+        **catalog.extractors["base"],
         "features" : [ (name, "empty") for name in base_feature_names() ],
         "compute" : compute_base_features,
     },
     "gate" : {
-        "description" : "Extract gate features from CNF files. ",
-        "contexts" : [ "cnf" ],
+        **catalog.extractors["gate"],
         "features" : [ (name, "empty") for name in gate_feature_names() ],
         "compute" : compute_gate_features,
     },
     "isohash" : {
-        "description" : "Compute ISOHash for CNF or WCNF files. ",
-        "contexts" : [ "cnf", "wcnf" ],
+        **catalog.extractors["isohash"],
         "features" : [ ("wlh", "empty"), ("wltp", "empty"), ("wltc", "empty"), ("wlm", "empty"), ("wli", "empty"), ],
         "compute" : compute_isohash,
     },
     "wcnfbase" : {
-        "description" : "Extract base features from WCNF files. ",
-        "contexts" : [ "wcnf" ],
+        **catalog.extractors["wcnfbase"],
         "features" : [ (name, "empty") for name in wcnf_base_feature_names() ],
         "compute" : compute_wcnf_base_features,
     },
     "opbbase" : {
-        "description" : "Extract base features from OPB files. ",
-        "contexts" : [ "opb" ],
+        **catalog.extractors["opbbase"],
         "features" : [ (name, "empty") for name in opb_base_feature_names() ],
         "compute" : compute_opb_base_features,
     }
 }
 
 
-def init_features_generic(key: str, api: GBD, rlimits, df, target_db):
+def init_features_generic(key: str, api: GBD, rlimits, df, target_db, incremental=False, retry_failed=False):
     einfo = generic_extractors[key]
     context = api.database.dcontext(target_db)
     if not context in einfo["contexts"]:
         raise InitializerException("Target database context must be in {}".format(einfo["contexts"]))
-    extractor = Initializer(api, rlimits, target_db, einfo["features"], einfo["compute"])
+    extractor = Initializer(api, rlimits, target_db, einfo["features"], einfo["compute"], job=key)
     extractor.create_features()
-    extractor.run(df)
+    extractor.run(df, incremental=incremental, retry_failed=retry_failed)
 
 
 def init_local(api: GBD, rlimits, root, target_db):
@@ -174,18 +170,43 @@ def init_local(api: GBD, rlimits, root, target_db):
     extractor = Initializer(api, rlimits, target_db, features, compute_hash)
     extractor.create_features()
 
-    # Cleanup stale entries
+    # Scan the tree once for all suffixes of the context
+    paths = set(scan_files(root, suffixes(context)))
+
+    # Cleanup stale entries, only paths not found by the scan need to be checked
     df = api.query(group_by=context + ":local")
-    dfilter = df["local"].apply(lambda x: not x or not os.path.isfile(x))
-    missing = df[dfilter]
+    known = set([ path for path in df["local"].tolist() if path ])
+    unseen = sorted(known - paths)
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        missing = [ path for (path, exists) in zip(unseen, pool.map(os.path.isfile, unseen)) if not exists ]
     if len(missing) and api.verbose:
-        for path in missing["local"].tolist():
+        for path in missing:
             eprint(path)
     if len(missing) and confirm("{} files not found. Remove stale entries from local table?".format(len(missing))):
-        api.reset_values("local", values=missing["local"].tolist())
+        api.reset_values("local", values=missing)
 
     # Create df with paths not yet in local table
-    paths = [ path for suffix in suffixes(context) for path in glob.iglob(root + "/**/*" + suffix, recursive=True) ]
-    df2 = pd.DataFrame([(None, path) for path in paths if not path in df["local"].to_list()], columns=["hash", "local"])
-    
+    df2 = pd.DataFrame([ (None, path) for path in sorted(paths - known) ], columns=["hash", "local"])
+
     extractor.run(df2)
+
+
+def verify_local(df, context, full=False):
+    """ Check that local benchmark files still have their hashes
+
+        Args:
+        df: pandas DataFrame with columns hash and local
+        context (str): context of the benchmarks
+        full (bool): hash all files again, otherwise unmodified files are looked up in the hash cache
+
+        Returns: generator of (hash, local, found) for files which are missing (found is None) or have another hash
+    """
+    for (hash, local) in zip(df["hash"].tolist(), df["local"].tolist()):
+        if not local:
+            continue
+        if not os.path.isfile(local):
+            yield (hash, local, None)
+        else:
+            found = identify(local, context, cache=not full)
+            if found != hash:
+                yield (hash, local, found)
@@ -14,9 +14,13 @@
 # copies or substantial portions of the Software.
 
 import multiprocessing
+import itertools
+import threading
+import queue
 import time
 import pebble
-from concurrent.futures import as_completed
+from concurrent.futures import wait, FIRST_COMPLETED, TimeoutError
+from dataclasses import dataclass
 import pandas as pd
 
 from gbd_core.util import eprint
@@ -25,18 +29,202 @@ from gbd_core import util
 import gbdc
 import os
 
+
+# number of results waiting for the writer, extraction results are not collected faster than they are written
+WRITER_QUEUE_SIZE = 1000
+
+# the writer commits after this many values or seconds, whatever comes first
+WRITER_BATCH_ROWS = 10000
+WRITER_BATCH_INTERVAL = 1.0
+
+# tasks in flight per job in parallel runs, keeps workers busy while the parent only holds a window of the instances
+TASKS_PER_JOB = 4
+
+# exit code of workers which exceeded the memory limit, the pool replaces them
+MEMOUT_EXIT_CODE = 86
+
+# statuses of instances in the job journal, instances which failed with the latter ones can be retried (e.g. with higher limits)
+JOURNAL_STATUSES = [ "done", "error", "crash", "timeout", "memout" ]
+RETRY_STATUSES = [ "timeout", "memout" ]
+
+
+# start time of the current worker process, reset by its first task
+worker_started = None
+
+def init_worker():
+    global worker_started
+    worker_started = time.perf_counter() - process_age()
+
+def process_age():
+    """ Seconds since the calling process was started (from /proc, 0 if not available) """
+    try:
+        with open("/proc/self/stat") as f:
+            starttime = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - starttime / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+def limit_memory(mlim):
+    """ Limit address space of the calling process to its current size plus mlim MB """
+    import resource
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        current = 0
+    limit = current + mlim * 2**20
+    (_, hard) = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+def run_task(initfunc, hash, path, limits):
+    """ Run initfunc in a pool worker
+
+        The memory limit is applied on the worker's first task (after its imports), workers exceeding it exit and are replaced.
+        Returns: (result, seconds spent in initfunc, seconds from worker start to its first task or 0 if the worker was reused)
+    """
+    global worker_started
+    start = time.perf_counter()
+    setup = 0.0
+    if worker_started is not None:
+        setup = start - worker_started
+        worker_started = None
+        if limits.get('mlim', 0) > 0:
+            limit_memory(limits['mlim'])
+    try:
+        result = initfunc(hash, path, limits)
+    except MemoryError:
+        os._exit(MEMOUT_EXIT_CODE)  # state of the worker is unreliable after a memout
+    return (result, time.perf_counter() - start, setup)
+
+
+@dataclass
+class WorkerStats:
+    tasks: int = 0
+    workers: int = 0
+    work: float = 0.0
+    setup: float = 0.0
+    timeouts: int = 0
+    memouts: int = 0
+    crashes: int = 0
+
+    def report(self):
+        overhead = 100 * self.setup / (self.setup + self.work) if self.setup + self.work > 0 else 0
+        return "{} tasks in {} worker processes: {:.1f} s extraction, {:.1f} s worker startup ({:.0f}% overhead), {} timeouts, {} memouts, {} crashes".format(
+            self.tasks, self.workers, self.work, self.setup, overhead, self.timeouts, self.memouts, self.crashes)
+
+
 class InitializerException(Exception):
     pass
 
+
+class ResultWriter:
+    """ Background stage which saves extraction results in batched transactions
+
+        Results are queued and written by a dedicated thread, one transaction per batch of batch_rows values or batch_interval seconds.
+        The queue is bounded, put() blocks while the writer is behind.
+        Each result can come with an entry for the job journal, save() writes (result, entry) pairs within the writer's transaction.
+        A failing batch is rolled back and its results are written one by one, such that one bad result does not discard the others.
+    """
+
+    def __init__(self, database, save, queue_size=WRITER_QUEUE_SIZE, batch_rows=WRITER_BATCH_ROWS, batch_interval=WRITER_BATCH_INTERVAL):
+        self.database = database
+        self.save = save
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_rows = batch_rows
+        self.batch_interval = batch_interval
+        self.results = 0
+        self.rows = 0
+        self.commits = 0
+        self.busy = 0.0
+        self.error = None
+        self.start = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name="gbd-writer", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        # flush queued results also if the producer failed
+        self.close()
+
+    def put(self, result: list, entry=None):
+        if self.error is not None:
+            raise InitializerException("Writer failed: {}".format(self.error))
+        self.queue.put((result, entry))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        batch, rows = [ ], 0
+        deadline = time.monotonic() + self.batch_interval
+        done = False
+        while not done:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                if item is None:
+                    done = True
+                else:
+                    batch.append(item)
+                    rows = rows + len(item[0])
+            except queue.Empty:
+                pass
+            if done or rows >= self.batch_rows or time.monotonic() >= deadline:
+                if len(batch) and self.error is None:  # after a fatal error, results are only drained
+                    try:
+                        self.flush(batch)
+                    except Exception as e:
+                        self.error = e
+                        eprint("{}: {}".format(e.__class__.__name__, e))
+                batch, rows = [ ], 0
+                deadline = time.monotonic() + self.batch_interval
+
+    def flush(self, batch: list):
+        start = time.perf_counter()
+        try:
+            self.save(batch)
+            self.database.pool.commit()
+            self.commits = self.commits + 1
+            self.results = self.results + len(batch)
+            self.rows = self.rows + sum(len(result) for (result, _) in batch)
+        except Exception:
+            self.database.pool.rollback()
+            for item in batch:
+                try:
+                    self.save([ item ])
+                    self.database.pool.commit()
+                    self.commits = self.commits + 1
+                    self.results = self.results + 1
+                    self.rows = self.rows + len(item[0])
+                except Exception as e:
+                    self.database.pool.rollback()
+                    eprint("{}: {}".format(e.__class__.__name__, e))
+        self.busy = self.busy + time.perf_counter() - start
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        return "Saved {} values of {} results in {} transactions ({:.0f} values/s, writer busy {:.1f} of {:.1f} s)".format(
+            self.rows, self.results, self.commits, self.rows / self.busy if self.busy > 0 else 0, self.busy, elapsed)
+
 class Initializer:
 
-    def __init__(self, api: GBD, rlimits: dict, target_db: str, features: list, initfunc):
+    # job: name under which processed instances are recorded in the job journal of the target database (no journal if None)
+    def __init__(self, api: GBD, rlimits: dict, target_db: str, features: list, initfunc, job=None):
         self.api = api
         self.api.database.set_auto_commit(False)
         self.target_db = target_db
         self.features = features
         self.initfunc = initfunc
         self.rlimits = rlimits
+        self.job = job
+        self.stats = WorkerStats()
 
     def prep_data(self, rec, hash):
         return [(key, hash, int(value) if isinstance(value, float) and value.is_integer() else value) for key, value in
@@ -47,40 +235,161 @@ class Initializer:
         for (name, default) in self.features:
             self.api.database.create_feature(name, default, self.target_db, True)
         self.api.database.commit()
+        if self.job is not None:
+            # tables with leading underscore are not considered features
+            sql = "CREATE TABLE IF NOT EXISTS _journal (job TEXT NOT NULL, hash TEXT NOT NULL, status TEXT NOT NULL, time REAL, PRIMARY KEY (job, hash))"
+            self.api.database.schemas[self.target_db].execute(sql)
+
+
+    def journal(self, statuses=None):
+        """ Instances (by hash, or by path if their hash is not known in advance) recorded in the job journal
+
+            Args:
+            statuses (list): restrict to instances with these statuses (see JOURNAL_STATUSES)
+
+            Returns: set of hashes and paths
+        """
+        if self.job is None:
+            return set()
+        sql = "SELECT hash FROM _journal WHERE job = ?"
+        if statuses:
+            sql = sql + " AND status IN ({})".format(", ".join([ "?" for _ in statuses ]))
+        con = self.api.database.schemas[self.target_db].get_connection()
+        return set([ key for (key, ) in con.execute(sql, [ self.job ] + list(statuses or [ ])) ])
 
 
-    def save_features(self, result: list):
+    def completed(self):
+        """ Hashes for which all features of the initializer are set to non-default values in the target database """
+        if not len(self.features):
+            return set()
+        # the features table has a column per feature, which refers to the values of 1:n features or is 'None'
+        conditions = [ "{c} != '{d}'".format(c=name, d="None" if default is None else default) for (name, default) in self.features ]
+        sql = "SELECT hash FROM {}.features WHERE {}".format(self.target_db, " AND ".join(conditions))
+        return set([ hash for (hash, ) in self.api.database.query(sql) ])
+
+
+    def entry(self, hash, local, status):
+        if self.job is None:
+            return None
+        return (self.job, hash or local, status, time.time())
+
+
+    def save_features(self, result: list, commit=True):
+        pairs = dict()
         for attr in result:
             name, hashv, value = attr[0], attr[1], attr[2]
-            self.api.database.set_values(name, value, [hashv], self.target_db)
-        self.api.database.commit()
+            pairs.setdefault(name, []).append((hashv, value))
+        for name, values in pairs.items():
+            self.api.database.set_values_bulk(name, values, self.target_db, commit=commit)
+        if commit:
+            self.api.database.commit()
 
 
-    def run(self, instances: pd.DataFrame):
-        if self.rlimits['jobs'] == 1:
-            self.init_sequential(instances)
-        else:
-            self.init_parallel_pp(instances)
+    def save_batch(self, items: list):
+        """ Save (result, journal entry) pairs without committing, see ResultWriter """
+        self.save_features(list(itertools.chain.from_iterable([ result for (result, _) in items ])), commit=False)
+        entries = [ entry for (_, entry) in items if entry is not None ]
+        if len(entries):
+            con = self.api.database.schemas[self.target_db].get_connection()
+            con.executemany("INSERT OR REPLACE INTO _journal (job, hash, status, time) VALUES (?, ?, ?, ?)", entries)
 
-    def init_sequential(self, instances: pd.DataFrame):
-        for _, row in instances.iterrows():
-            result = self.initfunc(row['hash'], row['local'], self.rlimits)
-            self.save_features(result)
 
-    def init_parallel_pp(self, instances: pd.DataFrame):
-        with pebble.ProcessPool(max_workers=self.rlimits['jobs'], max_tasks=1, context=multiprocessing.get_context('forkserver')) as p:
-            futures = [ p.schedule(self.initfunc, (row['hash'], row['local'], self.rlimits)) for idx, row in instances.iterrows() ]
-            for f in as_completed(futures):  #, timeout=api.tlim if api.tlim > 0 else None):
-                try:
-                    result = f.result()
-                    self.save_features(result)
-                except pebble.ProcessExpired as e:
+    def run(self, instances, incremental=False, retry_failed=False):
+        """ Compute and save features of the given instances
+
+            Args:
+            instances: pandas DataFrame with columns hash and local, or iterable of (hash, local) pairs which is consumed lazily (e.g. a generator over a streamed query)
+            incremental (bool): skip instances which have all features set or which are recorded in the job journal (resumes interrupted runs)
+            retry_failed (bool): only process instances which are recorded in the job journal with a timeout or memout
+        """
+        rows = self.rows(instances)
+        if retry_failed:
+            failed = self.journal(RETRY_STATUSES)
+            rows = ( (hash, local) for (hash, local) in rows if (hash or local) in failed )
+        elif incremental:
+            skip = self.completed() | self.journal()
+            rows = ( (hash, local) for (hash, local) in rows if not (hash or local) in skip )
+        # results are saved by a writer thread, the main thread only collects them
+        with ResultWriter(self.api.database, self.save_batch) as writer:
+            if self.rlimits['jobs'] == 1:
+                self.init_sequential(rows, writer)
+            else:
+                self.init_parallel_pp(rows, writer)
+        if writer.error is not None:
+            raise InitializerException("Writer failed: {}".format(writer.error))
+        if self.api.verbose:
+            if self.stats.tasks:
+                eprint(self.stats.report())
+            eprint(writer.report())
+
+    @classmethod
+    def rows(cls, instances):
+        if isinstance(instances, pd.DataFrame):
+            return zip(instances['hash'], instances['local'])
+        return iter(instances)
+
+    def init_sequential(self, instances, writer: ResultWriter):
+        for (hash, local) in self.rows(instances):
+            result = self.initfunc(hash, local, self.rlimits)
+            writer.put(result, self.entry(hash, local, "done"))
+
+    def init_parallel_pp(self, instances, writer: ResultWriter):
+        # sliding window: a new task is scheduled whenever one completes
+        window = self.rlimits['jobs'] * TASKS_PER_JOB
+        rows = self.rows(instances)
+        # workers are reused for max_tasks tasks (0: until they breach a limit), a task which exceeds tlim is killed with its worker
+        max_tasks = self.rlimits.get('tasks', 0)
+        timeout = self.rlimits['tlim'] if self.rlimits.get('tlim', 0) > 0 else None
+        with pebble.ProcessPool(max_workers=self.rlimits['jobs'], max_tasks=max_tasks, initializer=init_worker, context=multiprocessing.get_context('forkserver')) as p:
+            pending = dict()
+            try:
+                for (hash, local) in rows:
+                    pending[p.schedule(run_task, (self.initfunc, hash, local, self.rlimits), timeout=timeout)] = (hash, local)
+                    while len(pending) >= window:
+                        (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+                        for f in done:
+                            self.collect(f, pending.pop(f), writer)
+                while len(pending):
+                    (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        self.collect(f, pending.pop(f), writer)
+            except BaseException:
+                # cancelled (e.g. by keyboard interrupt) or writer failed: stop workers, results collected so far are saved
+                for f in pending:
                     f.cancel()
-                    util.eprint("{}: {}".format(e.__class__.__name__, e))
-                except GBDException as e:  # might receive special handling in the future
-                    util.eprint("{}: {}".format(e.__class__.__name__, e))
-                except Exception as e:
-                    import traceback
-                    traceback.print_exc()
-                    util.eprint("{}: {}".format(e.__class__.__name__, e))
+                p.stop()
+                raise
 
+    def collect(self, future, instance, writer: ResultWriter):
+        (hash, local) = instance
+        self.stats.tasks = self.stats.tasks + 1
+        try:
+            (result, work, setup) = future.result()
+            self.stats.work = self.stats.work + work
+            if setup > 0:
+                self.stats.workers = self.stats.workers + 1
+                self.stats.setup = self.stats.setup + setup
+            writer.put(result, self.entry(hash, local, "done"))
+        except InitializerException:
+            raise
+        except TimeoutError:
+            self.stats.timeouts = self.stats.timeouts + 1
+            util.eprint("Timeout: {} exceeded {} seconds".format(local or hash, self.rlimits['tlim']))
+            writer.put([ ], self.entry(hash, local, "timeout"))
+        except pebble.ProcessExpired as e:
+            if e.exitcode == MEMOUT_EXIT_CODE:
+                self.stats.memouts = self.stats.memouts + 1
+                util.eprint("Memout: {} exceeded {} MB".format(local or hash, self.rlimits['mlim']))
+                writer.put([ ], self.entry(hash, local, "memout"))
+            else:
+                self.stats.crashes = self.stats.crashes + 1
+                util.eprint("{}: {} ({})".format(e.__class__.__name__, e, local or hash))
+                writer.put([ ], self.entry(hash, local, "crash"))
+        except GBDException as e:  # might receive special handling in the future
+            util.eprint("{}: {}".format(e.__class__.__name__, e))
+            writer.put([ ], self.entry(hash, local, "error"))
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            util.eprint("{}: {}".format(e.__class__.__name__, e))
+            writer.put([ ], self.entry(hash, local, "error"))
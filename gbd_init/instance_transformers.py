@@ -23,6 +23,7 @@ from gbd_core import util
 
 from gbd_core.contexts import identify
 from gbd_init.initializer import Initializer, InitializerException
+from gbd_init import catalog
 
 try:
     from gbdc import cnf2kis, sanitize
@@ -99,17 +100,13 @@ def transform_instances_generic(key: str, api: GBD, rlimits, query, hashes, targ
 
 generic_transformers = {
     "sanitize" : {
-        "description" : "Sanitize CNF files. ",
-        "source" : [ "cnf" ],
-        "target" : [ "sancnf" ],
+        **catalog.transformers["sanitize"],
         "features" : [ ('local', None) , ('to_cnf', None) ],
         "compute" : wrap_sanitize,
         "filename" : sanitized_filename,
     },
     "cnf2kis" : {
-        "description" : "Transform CNF files to k-ISP instances. ",
-        "source" : [ "cnf" ],
-        "target" : [ "kis" ],
+        **catalog.transformers["cnf2kis"],
         "features" : [ ('local', None), ('to_cnf', None), ('nodes', 'empty'), ('edges', 'empty'), ('k', 'empty') ],
         "compute" : wrap_cnf2kis,
         "filename" : kis_filename,
@@ -27,6 +27,7 @@ from gbd_core.database import DatabaseException
 from gbd_core.api import GBD, GBDException
 from gbd_core.grammar import ParserException
 from gbd_core.util import is_number
+from gbd_core.cache import LRUCache, dataframe_size
 from gbd_core import contexts
 
 app = flask.Flask(__name__)
@@ -81,7 +82,7 @@ def json_response(json_blob, msg, addr):
     return flask.Response(json_blob, status=200, mimetype="application/json")
 
 def page_response(context, query, database, page=0):
-    with GBD(app.config['contextdbs'][context]) as gbd:
+    with GBD(app.config['contextdbs'][context], cache=app.config['cache']) as gbd:
         start = page * 1000
         end = start + 1000
         error = None
@@ -130,7 +131,7 @@ def quick_search():
 @app.route("/getinstances", methods=['POST', 'GET'])
 def get_url_file():
     context = request_context(flask.request)
-    with GBD(app.config['contextdbs'][context]) as gbd:
+    with GBD(app.config['contextdbs'][context], cache=app.config['cache']) as gbd:
         query = request_query(flask.request)
         try:
             df = gbd.query(query)
@@ -160,7 +161,7 @@ def get_database_file(database=None):
 def get_file(hashvalue):
     context = request_context(flask.request)
     print(context, app.config['contextdbs'][context])
-    with GBD(app.config['contextdbs'][context]) as gbd:
+    with GBD(app.config['contextdbs'][context], cache=app.config['cache']) as gbd:
         df = gbd.query(hashes=[hashvalue], resolve=['local', 'filename'], collapse="MIN")
         if not len(df.index):
             return error_response("Hash '{}' not found".format(hashvalue), flask.request.remote_addr)
@@ -212,5 +213,7 @@ def serve(gbd: GBD, port: int = 5000, logdir: str = "/tmp"):
         app.config['features'][db] = [ f for f in gbd.get_features(db) if not f in [ "hash", "local" ] ]
         app.config['dbpaths'][db] = gbd.get_database_path(db)
     app.config['features_flat'] = [ f for f in gbd.get_features() if not f in [ "hash", "local" ] ]
+    # query results shared by all requests, invalidated by writes to the databases
+    app.config['cache'] = LRUCache(maxsize=1024, maxbytes=2**28, sizeof=dataframe_size)
 
     waitress.serve(app, host='0.0.0.0', port=port)
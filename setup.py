@@ -23,12 +23,14 @@ setup(name='gbd_tools',
   ],
   install_requires=[
     'flask',
-    'tatsu',
     'pandas',
     'waitress',
     'pebble',
     'gbdc'
   ],
+  extras_require={
+    'arrow': [ 'pyarrow' ]
+  },
   install_obsoletes=['global-benchmark-database-tool'],
   classifiers=[
     "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
@@ -0,0 +1,32 @@
+
+# Startup benchmark: import time of the query parser vs. compiling the grammar with tatsu at import time
+# Usage: PYTHONPATH=.. python3 bench_startup.py [repetitions]
+
+import subprocess
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPETS = {
+    "python (baseline)": "pass",
+    "gbd_core.grammar": "import gbd_core.grammar",
+    "gbd_core.grammar + parse": "from gbd_core.grammar import Parser; Parser('a = 1 and b like %x')",
+    "tatsu.compile(GRAMMAR)": "import tatsu; from gbd_core.grammar import Parser; tatsu.compile(Parser.GRAMMAR)",
+}
+
+def measure(snippet, repetitions):
+    code = "import time; t = time.perf_counter(); {}; print(time.perf_counter() - t)".format(snippet)
+    times = [ ]
+    for _ in range(repetitions):
+        out = subprocess.run([ sys.executable, "-c", code ], cwd=ROOT, capture_output=True, text=True)
+        if out.returncode != 0:
+            return None
+        times.append(float(out.stdout.strip()))
+    return min(times)
+
+if __name__ == '__main__':
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for (name, snippet) in SNIPPETS.items():
+        t = measure(snippet, repetitions)
+        print("{:30} {}".format(name, "n/a" if t is None else "{:8.1f} ms".format(t * 1000)))
@@ -3,8 +3,11 @@ import os
 import unittest
 import sqlite3
 
-from gbd_core.api import GBD, GBDException
-from gbd_core.schema import Schema
+from contextlib import closing
+
+from gbd_core.api import GBD, GBDException, QueryProfile
+from gbd_core.database import Database
+from gbd_core.schema import Schema, SchemaException
 
 from tests import util
 
@@ -110,4 +113,183 @@ class APITestCase(unittest.TestCase):
         self.api.database.commit()
         api2 = GBD([self.file2])
         df = api2.query("A = value1", resolve=["A"])
-        self.assertCountEqual(df["A"].tolist(), [ "value1" for _ in range(50) ])
\ No newline at end of file
+        self.assertCountEqual(df["A"].tolist(), [ "value1" for _ in range(50) ])
+
+    def test_set_values_bulk(self):
+        self.api.create_feature("A", None, self.name1)
+        self.api.create_feature("B", "empty", self.name1)
+        self.api.set_values_bulk("A", ((str(i), "it's {}".format(i % 3)) for i in range(100)), self.name1, batch_size=7)
+        self.api.set_values_bulk("B", [ (str(i), i) for i in range(50) ], self.name1)
+        df = self.api.query(None, hashes=[ str(i) for i in range(100) ], resolve=["A", "B"], collapse=None)
+        self.assertEqual(len(df.index), 100)
+        self.assertCountEqual(df['A'].unique().tolist(), [ "it's 0", "it's 1", "it's 2" ])
+        self.assertCountEqual(df['B'].tolist(), [ str(i) for i in range(50) ] + [ "empty" for _ in range(50) ])
+        with self.assertRaises(GBDException):
+            self.api.set_values_bulk("C", [ ("0", "x") ])
+
+    def test_query_iter(self):
+        self.api.create_feature("A", "empty", self.name1)
+        self.api.set_values_bulk("A", [ (str(i), str(i % 5)) for i in range(95) ], self.name1)
+        df = self.api.query("A != empty", resolve=["A"])
+        rows = list(self.api.query_iter("A != empty", resolve=["A"], chunk_size=10))
+        self.assertEqual(rows, [ tuple(row) for row in df.itertuples(index=False) ])
+        chunks = list(self.api.query_iter("A != empty", resolve=["A"], chunk_size=10, as_frame=True))
+        self.assertEqual([ len(chunk.index) for chunk in chunks ], [ 10 ] * 9 + [ 5 ])
+        self.assertEqual(list(chunks[0].columns), [ "hash", "A" ])
+        with self.assertRaises(GBDException):
+            self.api.query_iter("A = ")
+
+    def test_typed_features(self):
+        self.api.create_feature("A", "0", self.name1, datatype="int", index=True)
+        self.api.create_feature("B", None, self.name1, datatype="real")
+        self.api.create_feature("C", "0", self.name1)
+        self.api.set_values_bulk("A", [ (str(i), i) for i in range(20) ], self.name1)
+        self.api.set_values_bulk("B", [ (str(i), i / 2) for i in range(20) ], self.name1)
+        self.api.set_values_bulk("C", [ (str(i), i) for i in range(20) ], self.name1)
+        self.assertEqual(self.api.database.find("A").datatype, "int")
+        self.assertEqual(self.api.database.find("C").datatype, "text")
+        for (typed, untyped) in [ ("A < 5", "C < 5"), ("B >= 7.5", "C >= 15"), ("A > (B * 1.5)", "C > 0") ]:
+            df = self.api.query(typed)
+            self.assertEqual(df['hash'].tolist(), self.api.query(untyped)['hash'].tolist())
+        df = self.api.query("A < 3", resolve=[ "A", "B", "C" ], collapse="MIN")
+        self.assertEqual(str(df['A'].dtype), "Int64")
+        self.assertEqual(str(df['B'].dtype), "float64")
+        self.assertEqual(df['A'].tolist(), [ 0, 1, 2 ])
+        self.assertEqual(df['B'].tolist(), [ 0.0, 0.5, 1.0 ])
+        with self.assertRaises(SchemaException):
+            self.api.set_values("A", "abc", [ "1" ], self.name1)
+        with self.assertRaises(SchemaException):
+            self.api.create_feature("D", "x", self.name1, datatype="real")
+        api = GBD([ self.file1 ])  # types are read back from the schema
+        self.assertEqual(api.database.find("B").datatype, "real")
+
+    def test_reset_and_delete_many(self):
+        self.api.create_feature("A", None, self.name1)
+        self.api.create_feature("B", "empty", self.name1)
+        hashes = [ str(i) for i in range(5000) ]
+        self.api.set_values_bulk("A", [ (h, "v{}".format(int(h) % 3)) for h in hashes ], self.name1)
+        self.api.set_values_bulk("A", [ (h, "w") for h in hashes[:100] ], self.name1)
+        self.api.set_values_bulk("B", [ (h, "b") for h in hashes ], self.name1)
+        # 1:n: hashes without remaining values point to 'None'
+        self.api.reset_values("A", [ "v0", "v1", "v2" ], hashes[:3000], self.name1)
+        df = self.api.query("A = w", resolve=["A"], collapse=None)
+        self.assertEqual(len(df.index), 100)
+        self.assertEqual(len(self.api.query("A != None").index), 2000 + 100)
+        # 1:1: values are reset to default
+        self.api.reset_values("B", hashes=hashes[:4000], target_db=self.name1)
+        self.assertEqual(len(self.api.query("B = b").index), 1000)
+        # remove hashes from all tables of the default database
+        self.api.delete_hashes(hashes[:4500])
+        self.assertEqual(len(self.api.query(None, resolve=["A", "B"]).index), 500)
+
+    def test_copy_feature(self):
+        self.api.create_feature("A", None, self.name1)
+        self.api.create_feature("B", "empty", self.name1)
+        self.api.set_values_bulk("A", [ (str(i), "v{}".format(i % 2)) for i in range(30) ], self.name1)
+        self.api.set_values_bulk("A", [ (str(i), "w") for i in range(10) ], self.name1)
+        self.api.set_values_bulk("B", [ (str(i), "b{}".format(i)) for i in range(30) ], self.name1)
+        self.api.copy_feature("A", "C", self.name2, "B = b3 or B = b20")
+        df = self.api.query(None, resolve=[ "{}:C".format(self.name2) ], collapse=None, group_by="{}:hash".format(self.name2))
+        self.assertCountEqual(df["C"].tolist(), [ "v1", "w", "v0" ])
+        self.api.database.copy_feature("B", "C", self.name2, chunk_size=7)
+        df = self.api.query("C = b5", group_by="{}:hash".format(self.name2))
+        self.assertEqual(df["hash"].tolist(), [ "5" ])
+
+    def test_move_feature(self):
+        self.api.create_feature("A", None, self.name1, datatype="int")
+        self.api.create_feature("B", "0", self.name1, index=True)
+        self.api.set_values_bulk("A", [ (str(i), i) for i in range(20) ], self.name1)
+        self.api.set_values_bulk("B", [ (str(i), i) for i in range(20) ], self.name1)
+        self.api.move_feature("A", self.name2)
+        self.api.move_feature("B", self.name2)
+        self.assertNotIn("A", self.api.get_features(self.name1))
+        self.assertEqual(self.api.database.find("A").datatype, "int")
+        self.assertEqual(self.api.database.find("B").default, "0")
+        self.assertIn("B", [ f for (_, f) in self.api.get_indexes(self.name2) ])
+        df = self.api.query("A < 5 and B > 2", resolve=[ "A" ], collapse=None, group_by="{}:hash".format(self.name2))
+        self.assertEqual(df["A"].tolist(), [ 3, 4 ])
+        with self.assertRaises(GBDException):
+            self.api.move_feature("A", self.name2)
+        # 1:n feature
+        self.api.create_feature("C", None, self.name1)
+        self.api.set_values_bulk("C", [ (str(i), "v{}".format(i % 2)) for i in range(10) ], self.name1)
+        self.api.move_feature("C", self.name2)
+        self.api.database.commit()
+        api2 = GBD([self.file1, self.file2])
+        self.assertNotIn("C", api2.get_features(self.name1))
+        self.assertEqual(api2.database.find("C").database, self.name2)
+        self.assertEqual(sorted(api2.query("C = v1")["hash"].tolist()), [ "1", "3", "5", "7", "9" ])
+        df = api2.query(None, resolve=[ "C" ], collapse=None, group_by="{}:hash".format(self.name2))
+        self.assertEqual(sorted([ value for value in df["C"].tolist() if value != "None" ]), [ "v0" ] * 5 + [ "v1" ] * 5)
+
+    def test_create_indexes(self):
+        self.api.create_feature("B", "0", self.name1)
+        self.api.create_feature("A", None, self.name1)
+        self.api.set_values_bulk("A", [ (str(i), "a{}".format(i % 2)) for i in range(10) ], self.name1)
+        self.api.create_indexes([ "A", "B" ], self.name1)
+        api2 = GBD([self.file1])
+        self.assertEqual(sorted(api2.get_features()), [ "A", "B" ])  # no statistics tables of the query planner
+        df = api2.query(None, resolve=api2.get_features())
+        self.assertEqual(len(df.index), 10)
+
+    def test_feature_info(self):
+        self.api.create_feature("A", None, self.name1)
+        self.api.create_feature("B", "empty", self.name1)
+        self.api.set_values_bulk("A", [ (str(i), "v{}".format(i % 3)) for i in range(30) ], self.name1)
+        self.api.set_values_bulk("A", [ (str(i), "w") for i in range(2) ], self.name1)
+        self.api.set_values_bulk("B", [ (str(i), str(i - 5)) for i in range(20) ], self.name1)
+        info = self.api.get_feature_info("A", top=3)
+        self.assertEqual(info['feature_count'], 32)
+        self.assertEqual(info['feature_distinct'], 4)
+        self.assertIsNone(info['feature_min'])
+        self.assertEqual(info['feature_values'], "v0 v1 v2")
+        info = self.api.get_feature_info("B")
+        self.assertEqual((info['feature_min'], info['feature_max']), (-5, 14))
+        self.assertEqual(info['feature_values'], "empty")  # default value of hashes 20 to 29
+        # statistics are recomputed after writes
+        self.api.set_values("B", "x", [ "100", "101" ], self.name1)
+        info = self.api.get_feature_info("B")
+        self.assertEqual(info['feature_count'], 32)
+        self.assertEqual(info['feature_values'], "empty x")
+        # most frequent values without the JSON1 extension
+        stats = self.api.database.feature_stats("A", top=3)
+        json1 = Database.json1
+        try:
+            Database.json1 = False
+            Database.stats_cache.clear()
+            self.assertEqual(self.api.database.feature_stats("A", top=3), stats)
+        finally:
+            Database.json1 = json1
+
+    def test_explain_and_profile(self):
+        self.api.create_feature("A", "0", self.name1, index=True, datatype="int")
+        self.api.set_values_bulk("A", [ (str(i), i) for i in range(50) ], self.name1)
+        sql, plan = self.api.explain("A > 40", resolve=[ "A" ])
+        self.assertEqual(sql, self.api.build_query("A > 40", resolve=[ "A" ])[0])
+        self.assertTrue(len(plan) > 0)
+        profile = QueryProfile()
+        df = self.api.query("A > 40", resolve=[ "A" ], profile=profile)
+        self.assertEqual(profile.rows, len(df.index))
+        self.assertEqual(profile.sql, sql)
+        self.assertAlmostEqual(profile.total(), sum([ profile.schema, profile.parse, profile.generate, profile.execute, profile.fetch, profile.frame ]))
+        self.assertIn("sql execution", profile.report())
+
+    def test_wal_journal(self):
+        self.assertEqual(self.api.checkpoint(), [ ])  # not in WAL mode
+        self.api.database.pool.close()
+        self.api = GBD([self.file1, self.file2], journal="wal", busy_timeout=1)
+        with closing(sqlite3.connect(self.file1)) as con:
+            self.assertEqual(con.execute("PRAGMA journal_mode").fetchone(), ("wal", ))
+        self.api.create_feature("A", None, self.name1)
+        self.api.set_values("A", "a", [ "h1", "h2" ], self.name1)
+        self.api.database.commit()
+        writer = sqlite3.connect(self.file1)
+        writer.execute("BEGIN IMMEDIATE")
+        writer.execute("INSERT INTO A VALUES ('h3', 'a')")
+        self.assertEqual(len(self.api.query("A = a").index), 2)  # readers do not wait for the writer
+        writer.commit()
+        writer.close()
+        self.assertEqual([ dbname for (dbname, _, _, _) in self.api.checkpoint(mode="truncate") ], [ self.name1, self.name2 ])
+        with self.assertRaises(GBDException):
+            self.api.checkpoint(mode="sometimes")
+        self.api.database.pool.close()  # last connection removes the write-ahead log
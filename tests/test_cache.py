@@ -0,0 +1,121 @@
+import os
+import shutil
+import sqlite3
+import unittest
+
+import pandas as pd
+
+from gbd_core.api import GBD
+from gbd_core.cache import LRUCache, DiskCache, HashCache, dataframe_size
+from gbd_core.schema import Schema
+
+from tests import util
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.file = util.get_random_unique_filename('test', '.db')
+        self.cachedir = util.get_random_unique_filename('cache', '')
+        sqlite3.connect(self.file).close()
+        self.name = Schema.dbname_from_path(self.file)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        if os.path.exists(self.file):
+            os.remove(self.file)
+        if os.path.exists(self.cachedir):
+            shutil.rmtree(self.cachedir)
+        return super().tearDown()
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        cache = LRUCache(maxbytes=10, sizeof=len)
+        cache.put("a", "x" * 6)
+        cache.put("b", "x" * 6)
+        self.assertEqual(len(cache), 1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_disk_cache(self):
+        cache = DiskCache(self.cachedir, maxbytes=2**20)
+        df = pd.DataFrame([ ("a", "1"), ("b", "2") ], columns=["hash", "x"])
+        cache.put(("sql", 1), df)
+        self.assertTrue(cache.get(("sql", 1)).equals(df))
+        self.assertIsNone(cache.get(("sql", 2)))
+        self.assertEqual(cache.info()['entries'], 1)
+
+    def test_hash_cache(self):
+        os.makedirs(self.cachedir)
+        cache = HashCache(os.path.join(self.cachedir, "hashes.db"), maxentries=2)
+        calls = [ ]
+        def hashfunc(path):
+            calls.append(path)
+            with open(path) as f:
+                return f.read()
+        paths = [ os.path.join(self.cachedir, name + ".cnf") for name in "abc" ]
+        for path in paths:
+            with open(path, 'w') as f:
+                f.write(os.path.basename(path))
+            os.utime(path, (1e9, 1e9))
+        self.assertEqual(cache.compute(paths[0], "cnf", hashfunc), "a.cnf")
+        self.assertEqual(cache.compute(paths[0], "cnf", hashfunc), "a.cnf")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.compute(paths[0], "wcnf", hashfunc), "a.cnf")
+        self.assertEqual(len(calls), 2)
+        # modified files are hashed again, their previous entry is replaced
+        with open(paths[0], 'w') as f:
+            f.write("changed")
+        os.utime(paths[0], (2e9, 2e9))
+        self.assertEqual(cache.compute(paths[0], "cnf", hashfunc), "changed")
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(cache.info()['entries'], 2)
+        # recently modified files are not cached
+        os.utime(paths[1])
+        cache.compute(paths[1], "cnf", hashfunc)
+        cache.compute(paths[1], "cnf", hashfunc)
+        self.assertEqual(len(calls), 5)
+        cache.compute(paths[2], "cnf", hashfunc)
+        cache.evict()
+        self.assertEqual(cache.info()['entries'], 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 6))
+        cache.close()
+
+    def test_hash_cache_racy_rewrite(self):
+        os.makedirs(self.cachedir)
+        cache = HashCache(os.path.join(self.cachedir, "hashes.db"))
+        path = os.path.join(self.cachedir, "a.cnf")
+        def hashfunc(path):
+            with open(path) as f:
+                return f.read()
+        with open(path, 'w') as f:
+            f.write("old")
+        mtime = os.stat(path).st_mtime_ns
+        self.assertEqual(cache.compute(path, "cnf", hashfunc), "old")
+        # rewritten within the racy interval, size and modification time do not change
+        with open(path, 'w') as f:
+            f.write("new")
+        os.utime(path, ns=(mtime, mtime))
+        self.assertEqual(cache.compute(path, "cnf", hashfunc), "new")
+        self.assertEqual((cache.hits, cache.info()['entries']), (0, 0))
+        cache.close()
+
+    def test_query_cache_invalidation(self):
+        for cache in [ LRUCache(sizeof=dataframe_size), DiskCache(self.cachedir) ]:
+            with GBD([self.file], cache=cache) as api:
+                if not api.feature_exists("A"):
+                    api.create_feature("A", "empty")
+                api.set_values("A", "x", [ "a", "b" ])
+                df = api.query("A = x", resolve=["A"])
+                self.assertEqual(len(df.index), 2)
+                df.drop(df.index, inplace=True)
+                self.assertEqual(len(api.query("A = x", resolve=["A"]).index), 2)
+                self.assertEqual(cache.hits, 1)
+                api.set_values("A", "y", [ "a" ])
+                self.assertEqual(len(api.query("A = x", resolve=["A"]).index), 1)
+                self.assertEqual(cache.hits, 1)
@@ -0,0 +1,58 @@
+
+# MIT License
+
+# Copyright (c) 2023 Markus Iser, Karlsruhe Institute of Technology (KIT)
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+import os
+import sys
+import json
+import subprocess
+import unittest
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = [ "pandas", "pebble", "multiprocessing", "gbd_init.feature_extractors", "gbd_init.instance_transformers" ]
+
+class CommandLineInterfaceTestCase(unittest.TestCase):
+
+    def run_python(self, code):
+        out = subprocess.run([ sys.executable, "-c", code ], cwd=ROOT, capture_output=True, text=True)
+        self.assertEqual(out.returncode, 0, out.stderr)
+        return out.stdout
+
+    def test_import_is_lightweight(self):
+        code = "import sys, json, gbd; sys.argv = [ 'gbd', 'info', '--contexts' ]; gbd.main(); print(json.dumps(sorted(sys.modules)))"
+        modules = json.loads(self.run_python(code).splitlines()[-1])
+        for name in HEAVY_MODULES:
+            self.assertNotIn(name, modules)
+
+    def import_time(self, module):
+        code = "import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)".format(module)
+        return min(float(self.run_python(code)) for _ in range(3))
+
+    @unittest.skipUnless(importlib.util.find_spec("pandas"), "requires pandas")
+    def test_import_time(self):
+        baseline = self.import_time("pandas")
+        # relative to the heavy dependencies which are only loaded on demand, absolute times depend on the machine
+        self.assertLess(self.import_time("gbd"), baseline / 2)
+
+    def test_catalog_matches_implementations(self):
+        try:
+            from gbd_init.feature_extractors import generic_extractors
+            from gbd_init.instance_transformers import generic_transformers
+        except ImportError as e:
+            self.skipTest("Missing module: {}".format(e.name))
+        from gbd_init import catalog
+        self.assertEqual(set(catalog.extractors.keys()), set(generic_extractors.keys()))
+        self.assertEqual(set(catalog.transformers.keys()), set(generic_transformers.keys()))
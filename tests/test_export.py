@@ -0,0 +1,111 @@
+import os
+import csv
+import json
+import sqlite3
+import unittest
+import importlib.util
+
+from gbd_core.api import GBD
+from gbd_core.schema import Schema
+from gbd_core import export
+
+from tests import util
+
+class ExportTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.file = util.get_random_unique_filename('test', '.db')
+        self.out = util.get_random_unique_filename('test', '.out')
+        sqlite3.connect(self.file).close()
+        self.name = Schema.dbname_from_path(self.file)
+        self.api = GBD([self.file])
+        self.api.create_feature("i", "empty", self.name)
+        self.api.create_feature("r", "empty", self.name)
+        self.api.create_feature("t", None, self.name)
+        self.api.set_values_bulk("i", [ (str(i), str(i)) for i in range(25) ], self.name)
+        self.api.set_values_bulk("r", [ (str(i), str(i / 4)) for i in range(25) ], self.name)
+        self.api.set_values_bulk("t", [ (str(i), "0{}".format(i)) for i in range(25) ], self.name)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        for file in [ self.file, self.out ]:
+            if os.path.exists(file):
+                os.remove(file)
+        return super().tearDown()
+
+    def test_type_rank(self):
+        self.assertEqual(export.type_rank(None), export.NULL)
+        self.assertEqual(export.type_rank("-12"), export.INTEGER)
+        self.assertEqual(export.type_rank("012"), export.TEXT)
+        self.assertEqual(export.type_rank("+12"), export.REAL)
+        self.assertEqual(export.type_rank("1.5e3"), export.REAL)
+        self.assertEqual(export.type_rank(str(2**64)), export.REAL)
+        self.assertEqual(export.type_rank("1,2"), export.TEXT)
+
+    def test_column_types(self):
+        sql, cols = self.api.build_query("i != empty", resolve=[ "i", "r", "t" ])
+        self.assertEqual(self.api.column_types(sql, cols), [ "text", "int", "real", "text" ])
+        sql, cols = self.api.build_query("i < 3 or i > 10", resolve=[ "i" ], group_by="r", collapse="group_concat")
+        self.assertEqual(self.api.column_types(sql, cols), [ "real", "int" ])
+        self.api.set_values("i", "1", [ str(i) for i in range(25) ], self.name)
+        sql, cols = self.api.build_query(resolve=[ "r" ], group_by="i", collapse="group_concat")
+        self.assertEqual(self.api.column_types(sql, cols), [ "int", "text" ])
+
+    def test_typed_chunks(self):
+        chunks = [ [ ("a", "1", "x"), ("b", "2", None) ], [ ("c", "3.5", "y") ] ]
+        types, typed = export.typed_chunks(chunks, [ "hash", "n", "t" ])
+        self.assertEqual(types, [ "text", "real", "text" ])  # settled by all chunks
+        self.assertEqual(list(typed), chunks)
+        consumed = [ ]
+        def stream():
+            for chunk in chunks:
+                consumed.append(chunk)
+                yield chunk
+        types, typed = export.typed_chunks(stream(), [ "hash", "n", "t" ], [ "text", "real", "text" ])
+        self.assertEqual(consumed, [ ])  # declared types need no pass over the result
+        self.assertEqual(list(typed), chunks)
+
+    def test_mixed_column_across_chunks(self):
+        self.api.create_feature("runtime", "empty", self.name)
+        self.api.set_values_bulk("runtime", [ (str(i), str(i * 10)) for i in range(24) ], self.name)
+        self.api.set_values("runtime", "timeout", [ "24" ], self.name)
+        sql, cols = self.api.build_query(None, resolve=[ "runtime" ])
+        first = next(self.api.stream(sql, cols, 5))
+        self.assertEqual(export.column_types(first, cols), [ "text", "int" ])  # the timeout is in a later chunk
+        types, chunks = export.typed_chunks(self.api.stream(sql, cols, 5), cols, self.api.declared_types([ "runtime" ]))
+        self.assertEqual(types, [ "text", "text" ])
+        export.write(chunks, cols, types, "jsonl", self.out)
+        with open(self.out) as file:
+            records = { record["hash"]: record["runtime"] for record in map(json.loads, file) }
+        self.assertEqual(records, dict([ (str(i), str(i * 10)) for i in range(24) ] + [ ("24", "timeout") ]))
+        if importlib.util.find_spec("pyarrow"):
+            table = self.api.query(None, resolve=[ "runtime" ], as_arrow=True)
+            self.assertIn("timeout", table.column("runtime").to_pylist())
+
+    def test_write_csv_and_jsonl(self):
+        sql, cols = self.api.build_query("i != empty", resolve=[ "i", "r" ])
+        types = self.api.column_types(sql, cols)
+        export.write(self.api.stream(sql, cols, 10), cols, types, "csv", self.out)
+        with open(self.out, newline="") as file:
+            rows = list(csv.reader(file))
+        self.assertEqual(rows[0], [ "hash", "i", "r" ])
+        self.assertEqual(len(rows), 26)
+        export.write(self.api.stream(sql, cols, 10), cols, types, "jsonl", self.out)
+        with open(self.out) as file:
+            records = [ json.loads(line) for line in file ]
+        self.assertEqual(len(records), 25)
+        self.assertIn({ "hash": "5", "i": 5, "r": 1.25 }, records)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "requires pyarrow")
+    def test_write_arrow_and_parquet(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = self.api.query("i != empty", resolve=[ "i", "r" ], as_arrow=True)
+        self.assertEqual(table.schema.types, [ pa.string(), pa.int64(), pa.float64() ])
+        self.assertEqual(sorted(table.column("i").to_pylist()), list(range(25)))
+        sql, cols = self.api.build_query("i != empty", resolve=[ "i", "r" ])
+        types = self.api.column_types(sql, cols)
+        export.write(self.api.stream(sql, cols, 10), cols, types, "parquet", self.out)
+        self.assertTrue(pq.read_table(self.out).equals(table))
+        export.write(self.api.stream(sql, cols, 10), cols, types, "arrow", self.out)
+        self.assertTrue(pa.ipc.open_file(self.out).read_all().equals(table))
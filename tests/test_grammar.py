@@ -1,5 +1,7 @@
 
 import unittest
+import importlib.util
+import json
 
 from gbd_core.grammar import Parser, ParserException
 
@@ -55,4 +57,30 @@ class SchemaTestCase(unittest.TestCase):
         parser = Parser("c:a = 1")
         self.assertEqual(parser.get_features(), set(["c:a"]))
         parser = Parser("c:a = 1 and d:b = 2")
-        self.assertEqual(parser.get_features(), set(["c:a", "d:b"]))
\ No newline at end of file
+        self.assertEqual(parser.get_features(), set(["c:a", "d:b"]))
+
+    def test_parse_cache(self):
+        Parser("cached = 1 and uncached = 2")
+        hits = Parser.cache.hits
+        parser = Parser("cached = 1 and uncached = 2")
+        self.assertEqual(Parser.cache.hits, hits + 1)
+        self.assertEqual(parser.get_features(), set(["cached", "uncached"]))
+
+    @unittest.skipUnless(importlib.util.find_spec("tatsu"), "tatsu not installed")
+    def test_model_matches_grammar(self):
+        import tatsu
+        model = tatsu.compile(Parser.GRAMMAR)
+        queries = [ "a = 1", "a=1 and b=2 or c=3", "a=1 or b=2 and c=3", "not a=1 and b=2", "(a=1 or b=2) and not c=3",
+                    "a = (1 + 2 * b)", "a = ((1))", "a != (c:b - -1)", "c : a = x", "a like %x%", "a unlike x%", "a like x",
+                    "a = 'x y '", 'a = "it\'s"', "a >= -1.5", "A = 1 AND b = 2", "notx=1", "not(a=1)", "a = and", "a=1and b=2",
+                    "a = 1abc", "a=1.2.3", "a=1 andb=2", "a=1 and_b=2", "not = 1", "a=1 or", "a = (1 +)", "a like '%x'", "x:y:z = 1" ]
+        for query in queries:
+            try:
+                expected = json.loads(json.dumps(tatsu.util.asjson(model.parse(query))))
+            except Exception:
+                expected = None
+            try:
+                result = json.loads(json.dumps(Parser.model.parse(query)))
+            except ParserException:
+                result = None
+            self.assertEqual(result, expected, query)
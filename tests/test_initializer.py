@@ -8,12 +8,23 @@ import sqlite3
 from gbd_core.database import Database
 from gbd_core.schema import Schema
 from gbd_core.api import GBD, GBDException
-from gbd_init.initializer import Initializer
+from gbd_init.initializer import Initializer, ResultWriter
 from gbd_core.contexts import identify
-from gbd_init.feature_extractors import init_local, init_features_generic, generic_extractors
+from gbd_init.feature_extractors import init_local, init_features_generic, generic_extractors, verify_local
 
 from tests import util
 
+def init_square(hash, path, limits):
+    return [ ('square', hash, int(hash) ** 2) ]
+
+def init_limited(hash, path, limits):
+    if hash == "2":
+        import time
+        time.sleep(10)
+    elif hash == "3":
+        hog = bytearray(2 * limits['mlim'] * 2**20)
+    return [ ('square', hash, int(hash) ** 2) ]
+
 class InitTestCase(unittest.TestCase):
 
     def setUp(self) -> None:
@@ -49,6 +60,86 @@ class InitTestCase(unittest.TestCase):
         df = api.query("random > 0", [], ["random"])
         self.assertEqual(len(df.index), 100)
 
+    def test_init_parallel_streamed(self):
+        api = GBD([self.file], verbose=False)
+        rlimits = { 'jobs': 2, 'tlim': 5000, 'mlim': 2000, 'flim': 1000 }
+        init = Initializer(api, rlimits, self.name, [('square', 0)], init_square)
+        init.create_features()
+        consumed = [ ]
+        def instances():
+            for n in range(1, 13):
+                consumed.append(n)
+                yield (str(n), None)
+        init.run(instances())
+        self.assertEqual(len(consumed), 12)
+        df = api.query("square > 0", [], ["square"])
+        self.assertEqual(sorted(df["square"].astype(int).tolist()), [ n * n for n in range(1, 13) ])
+
+    def test_init_parallel_limits(self):
+        api = GBD([self.file], verbose=False)
+        rlimits = { 'jobs': 2, 'tlim': 1, 'mlim': 100, 'flim': 1000, 'tasks': 0 }
+        init = Initializer(api, rlimits, self.name, [('square', 0)], init_limited, job="square")
+        init.create_features()
+        init.run([ (str(n), None) for n in range(1, 21) ])
+        self.assertEqual((init.stats.tasks, init.stats.timeouts, init.stats.memouts), (20, 1, 1))
+        self.assertLess(init.stats.workers, 20)  # workers are reused, and replaced after timeout and memout
+        self.assertIn("worker startup", init.stats.report())
+        df = api.query("square > 0", [], ["square"])
+        self.assertEqual(sorted(df["hash"].astype(int).tolist()), [ n for n in range(1, 21) if n not in [ 2, 3 ] ])
+        self.assertEqual(init.journal([ "timeout" ]), { "2" })
+        self.assertEqual(init.journal([ "memout" ]), { "3" })
+        self.assertEqual(len(init.journal([ "done" ])), 18)
+        retry = Initializer(api, rlimits, self.name, [('square', 0)], init_limited, job="square")
+        retry.create_features()
+        retry.run([ (str(n), None) for n in range(1, 21) ], retry_failed=True)
+        self.assertEqual((retry.stats.tasks, retry.stats.timeouts, retry.stats.memouts), (2, 1, 1))
+
+    def test_init_incremental(self):
+        api = GBD([self.file], verbose=False)
+        rlimits = { 'jobs': 1, 'tlim': 5000, 'mlim': 2000, 'flim': 1000 }
+        api.create_feature("square", 0, self.name)
+        api.set_values("square", 25, [ "5" ], self.name)
+        api.set_values("square", 0, [ "6" ], self.name)
+        computed = [ ]
+        def init_counted(hash, path, limits):
+            computed.append(hash)
+            return init_square(hash, path, limits)
+        init = Initializer(api, rlimits, self.name, [('square', 0)], init_counted, job="square")
+        init.create_features()
+        init.run([ (str(n), None) for n in range(1, 9) ], incremental=True)
+        self.assertEqual(computed, [ "1", "2", "3", "4", "6", "7", "8" ])
+        self.assertEqual(init.journal([ "done" ]), set([ str(n) for n in range(1, 9) if n != 5 ]))
+        computed.clear()
+        init.run([ (str(n), None) for n in range(1, 11) ], incremental=True)
+        self.assertEqual(computed, [ "9", "10" ])
+        computed.clear()
+        init.run([ (str(n), None) for n in range(1, 11) ], retry_failed=True)
+        self.assertEqual(computed, [ ])
+
+    def test_result_writer_batches(self):
+        api = GBD([self.file], verbose=False)
+        rlimits = { 'jobs': 1, 'tlim': 5000, 'mlim': 2000, 'flim': 1000 }
+        init = Initializer(api, rlimits, self.name, [('random', 0)], self.init_random)
+        init.create_features()
+        with ResultWriter(api.database, init.save_batch, queue_size=10, batch_rows=50, batch_interval=60) as writer:
+            for n in range(120):
+                writer.put(self.init_random(str(n), None, rlimits))
+        self.assertEqual((writer.results, writer.rows, writer.commits), (120, 120, 3))
+        self.assertIn("120 values", writer.report())
+        self.assertEqual(len(api.query("random > 0").index), 120)
+
+    def test_result_writer_skips_bad_results(self):
+        api = GBD([self.file], verbose=False)
+        api.create_feature("number", "0", self.name, datatype="int")
+        init = Initializer(api, dict(), self.name, [ ], None)
+        with ResultWriter(api.database, init.save_batch) as writer:
+            writer.put([ ('number', 'a', 1) ])
+            writer.put([ ('number', 'b', 'two') ])
+            writer.put([ ('number', 'c', 3) ])
+        self.assertIsNone(writer.error)
+        self.assertEqual(writer.results, 2)
+        self.assertEqual(sorted(api.query("number > 0")["hash"].tolist()), [ 'a', 'c' ])
+
     def test_init_local(self):
         api = GBD([self.file], verbose=False)
         rlimits = { 'jobs': 1, 'tlim': 5000, 'mlim': 2000, 'flim': 1000 }
@@ -59,6 +150,35 @@ class InitTestCase(unittest.TestCase):
         self.assertEqual(df.iloc[0]['local'], os.path.realpath(self.benchmark))
         self.assertEqual(df.iloc[0]['hash'], self.reference_hash)
 
+    def test_verify_local(self):
+        api = GBD([self.file], verbose=False)
+        rlimits = { 'jobs': 1, 'tlim': 5000, 'mlim': 2000, 'flim': 1000 }
+        init_local(api, rlimits, self.dir, self.name)
+        df = api.query("local like %benchmark.cnf", [], ["local"], collapse=None)
+        self.assertEqual(list(verify_local(df, "cnf")), [ ])
+        with open(self.benchmark, 'w') as file:
+            file.write(util.get_random_formula(20))
+        found = identify(self.benchmark)
+        self.assertEqual(list(verify_local(df, "cnf", full=True)), [ (self.reference_hash, df.iloc[0]['local'], found) ])
+        os.remove(self.benchmark)
+        self.assertEqual(list(verify_local(df, "cnf")), [ (self.reference_hash, df.iloc[0]['local'], None) ])
+
+    def test_scan_files(self):
+        import shutil, tempfile
+        from gbd_core.util import scan_files
+        root = tempfile.mkdtemp()
+        try:
+            files = [ "a.cnf", "b.cnf.xz", "c.txt", "x/d.cnf", "x/y/e.cnf.gz", ".hidden/f.cnf", "x/.g.cnf" ]
+            for name in files:
+                os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+                open(os.path.join(root, name), 'w').close()
+            os.symlink(root, os.path.join(root, "x", "loop"))
+            paths = [ os.path.relpath(path, root) for path in scan_files(root, [ ".cnf", ".cnf.xz", ".cnf.gz" ], threads=4) ]
+            self.assertEqual(sorted(set(paths)), [ "a.cnf", "b.cnf.xz", "x/d.cnf", "x/y/e.cnf.gz" ])
+            self.assertEqual(len(paths), 4)
+        finally:
+            shutil.rmtree(root)
+
     def test_init_cnf_features_generic(self):
         api = GBD([self.file], verbose=False)
         rlimits = { 'jobs': 1, 'tlim': 5000, 'mlim': 2000, 'flim': 1000 }
@@ -0,0 +1,125 @@
+import os
+import random
+import unittest
+import sqlite3
+
+from gbd_core.schema import Schema
+from gbd_core.database import Database
+from gbd_core.grammar import Parser
+from gbd_core.optimizer import QueryOptimizer
+from gbd_core.query import GBDQuery
+
+from tests import util
+
+class QueryOptimizerTestCase(unittest.TestCase):
+
+    hashes = [ "h{}".format(i) for i in range(20) ]
+
+    atoms = [ "family = a", "family != b", "family like a%", "family unlike %c", "family = None",
+              "tag = x", "tag != y", "tag like %x%", "tag = z", "tag = w",
+              "size > 3", "size <= 5", "size = 0", "size != family",
+              "score = 1", "score >= 2", "score != 3" ]
+
+    def setUp(self) -> None:
+        self.file1 = util.get_random_unique_filename('test1', '.db')
+        self.file2 = util.get_random_unique_filename('test2', '.db')
+        sqlite3.connect(self.file1).close()
+        sqlite3.connect(self.file2).close()
+        self.dbname2 = Schema.dbname_from_path(self.file2)
+        self.db = Database([self.file1, self.file2], verbose=False)
+
+        rng = random.Random(42)
+        self.db.create_feature("family", default_value=None)
+        self.db.create_feature("size", default_value=None, datatype="int")
+        self.db.create_feature("score", default_value=0)
+        self.db.create_feature("tag", default_value=None, target_db=self.dbname2)
+        for hash in self.hashes:
+            for value in rng.sample([ "a", "ab", "b", "c", "bc" ], rng.randint(0, 3)):
+                self.db.set_values("family", value, [ hash ])
+            for value in rng.sample(range(8), rng.randint(0, 2)):
+                self.db.set_values("size", value, [ hash ])
+            self.db.set_values("score", rng.randint(0, 4), [ hash ])
+            for value in rng.sample([ "x", "y", "z" ], rng.randint(0, 2)):
+                self.db.set_values("tag", value, [ hash ], target_db=self.dbname2)
+        # disjoint from all other tags, hashes without tags are missing in the second database
+        self.db.set_values("tag", "w", [ "hw" ], target_db=self.dbname2)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        GBDQuery.optimize = True
+        if os.path.exists(self.file1):
+            os.remove(self.file1)
+        if os.path.exists(self.file2):
+            os.remove(self.file2)
+        return super().tearDown()
+
+    def random_query(self, rng, depth=0):
+        if depth > 2 or rng.random() < 0.3:
+            return rng.choice(self.atoms)
+        query = rng.choice(self.atoms)
+        for _ in range(rng.randint(1, 3)):
+            query = "{} {} {}".format(query, rng.choice([ "and", "or" ]), self.random_query(rng, depth + 1))
+        if rng.random() < 0.3:
+            query = "( {} )".format(query)
+        if rng.random() < 0.2:
+            query = "not " + query
+        return query
+
+    def results(self, query, optimize, **kwargs):
+        GBDQuery.optimize = optimize
+        sql = GBDQuery(self.db, query).build_query(**kwargs)
+        return sorted(self.db.query(sql), key=repr)
+
+    def assert_unchanged(self, query, **kwargs):
+        self.assertEqual(self.results(query, False, **kwargs), self.results(query, True, **kwargs), query)
+
+    def test_random_queries_unchanged(self):
+        rng = random.Random(1)
+        for _ in range(300):
+            self.assert_unchanged(self.random_query(rng))
+
+    def test_random_queries_with_resolve_unchanged(self):
+        rng = random.Random(2)
+        for _ in range(50):
+            query = self.random_query(rng)
+            self.assert_unchanged(query, resolve=[ "family", "score" ])
+            self.assert_unchanged(query, resolve=[ "family", "size" ], collapse="group_concat")
+            self.assert_unchanged(query, resolve=[ "size" ], collapse="min", hashes=self.hashes[:10])
+
+    def test_operator_precedence_unchanged(self):
+        for query in [ "family = a and family = b or family = c", "family = a or family = b and family = c",
+                       "not family = a and family = b", "family = a and not family = b or family = c",
+                       "(family = a or family = b) and (family = b or family = c)" ]:
+            self.assert_unchanged(query)
+
+    def sql(self, query):
+        parser = Parser(query)
+        return parser.get_sql(self.db, QueryOptimizer(self.db, parser).optimize())
+
+    def test_merge_disjunction(self):
+        sql = self.sql("family = a or family = b or score = 1")
+        self.assertEqual(sql.count("SELECT"), 1)
+
+    def test_merge_conjunction(self):
+        sql = self.sql("family = a and family = b")
+        self.assertIn("INTERSECT", sql)
+        sql = self.sql("family != a and family unlike b%")
+        self.assertEqual(sql.count("NOT IN"), 1)
+        self.assertNotIn("INTERSECT", sql)
+
+    def test_no_intersect_under_negation(self):
+        sql = self.sql("not (family = a and family = b)")
+        self.assertNotIn("INTERSECT", sql)
+        sql = self.sql("not (not (family = a and family = b))")
+        self.assertIn("INTERSECT", sql)
+        self.assert_unchanged("not (tag = x and tag = w)")
+
+    def test_no_merge_across_tables(self):
+        sql = self.sql("family = a or tag = x")
+        self.assertEqual(sql.count("SELECT"), 2)
+
+    def test_drop_distinct_with_group_by(self):
+        sql = GBDQuery(self.db, "family = a").build_query(resolve=[ "family" ], collapse="group_concat")
+        self.assertNotIn("DISTINCT", sql.split("FROM")[0].replace("(DISTINCT", ""))
+        sql = GBDQuery(self.db, "family = a").build_query(resolve=[ "family" ])
+        self.assertTrue(sql.startswith("SELECT DISTINCT"))
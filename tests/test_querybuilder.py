@@ -4,6 +4,7 @@ import os
 
 from gbd_core.schema import Schema
 from gbd_core.database import Database
+from gbd_core import database
 from gbd_core.query import GBDQuery
 
 import tests.util as util
@@ -94,4 +95,39 @@ class QueryNonUniqueTestCase(unittest.TestCase):
 
     def test_feature_accessible(self):
         res = self.simple_query(self.feat2, self.val2)
-        self.assertEqual(len(res), 3)
\ No newline at end of file
+        self.assertEqual(len(res), 3)
+
+    def test_sql_cache(self):
+        query = "{} = {} and {} < 50".format(self.feat, self.val1, self.feat3)
+        first = GBDQuery(self.db, query).build_query(resolve=[ self.feat ])
+        hits = GBDQuery.cache.hits
+        self.assertEqual(GBDQuery(self.db, query).build_query(resolve=[ self.feat ]), first)
+        self.assertEqual(GBDQuery.cache.hits, hits + 1)
+        self.assertIn("'a'", GBDQuery(self.db, query).build_query(hashes=[ "a" ], resolve=[ self.feat ]))
+        # schema changes invalidate generated sql
+        self.db.delete_feature(self.feat, self.dbname1)
+        self.assertNotEqual(GBDQuery(self.db, query).build_query(resolve=[ self.feat ]), first)
+
+    def test_large_hash_restriction(self):
+        hashes = self.hashes[:2] + [ "x{}".format(i) for i in range(database.HASH_TABLE_THRESHOLD) ]
+        sql = GBDQuery(self.db, None).build_query(hashes=hashes, resolve=[ self.feat ])
+        self.assertNotIn("'x0'", sql)
+        self.assertCountEqual([ h for (h, _) in self.db.query(sql) ], self.hashes[:2])
+        # tables are named by content and reused
+        self.assertEqual(GBDQuery(self.db, None).build_query(hashes=list(reversed(hashes)), resolve=[ self.feat ]), sql)
+        self.assertEqual(len(self.db.hash_tables), 1)
+        literal = GBDQuery(self.db, None).build_query(hashes=self.hashes[:2], resolve=[ self.feat ])
+        self.assertEqual(self.db.query(sql), self.db.query(literal))
+
+    def test_hash_tables_keep_pending_writes(self):
+        hashes = self.hashes + [ "x{}".format(i) for i in range(database.HASH_TABLE_THRESHOLD) ]
+        self.db.set_auto_commit(False)
+        self.db.execute("UPDATE {}.features SET {} = 1000".format(self.dbname1, self.feat3))
+        sql = GBDQuery(self.db, "{} = 1000".format(self.feat3)).build_query(hashes=hashes)
+        self.assertEqual(len(self.db.query(sql)), 3)
+        self.db.hash_table_from_query(sql)
+        self.assertTrue(self.db.connection.in_transaction)  # temporary tables do not commit the caller's writes
+        self.db.connection.rollback()
+        sql = GBDQuery(self.db, "{} = 1000".format(self.feat3)).build_query(hashes=hashes)
+        self.assertEqual(len(self.db.query(sql)), 0)
+        self.assertEqual(len(self.db.query(GBDQuery(self.db, "{} = 10".format(self.feat3)).build_query(hashes=hashes))), 1)
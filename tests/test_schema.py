@@ -24,6 +24,21 @@ class SchemaTestCase(unittest.TestCase):
             os.remove(self.file)
         return super().tearDown()
 
+    def test_create_feature_defaults(self):
+        defaults = { "featA": "", "featB": "it's", "featC": "two words", "featD": "x-1", "featE": "007" }
+        for (name, default) in defaults.items():
+            self.db.create_feature(name, default_value=default)
+        self.db.create_feature("featF", default_value="None", datatype="int")
+        self.db.set_values("featB", "v", [ "h1" ])
+        self.db.commit()
+        with Database([self.file]) as db:
+            for (name, default) in defaults.items():
+                self.assertEqual(db.find(name).table, "features")
+                self.assertEqual(db.find(name).default, default or "None")
+            self.assertEqual(db.find("featF").default, "None")
+            row = db.query("SELECT featA, featB, featC, featD, featE, featF FROM features WHERE hash = 'h1'")
+            self.assertEqual(row, [ ("None", "v", "two words", "x-1", "007", "None") ])
+
     def test_create_db(self):
         self.assertTrue(Schema.is_database(self.file))
         self.assertEqual(len(self.db.get_databases()), 1)
@@ -51,3 +66,115 @@ class SchemaTestCase(unittest.TestCase):
         self.assertEqual(finfo.default, None)
         self.assertEqual(finfo.database, self.name)
 
+
+    def test_pooled_connections(self):
+        import threading
+        schema = self.db.schemas[self.name]
+        con = schema.get_connection()
+        self.assertIs(con, schema.get_connection())
+        other = [ ]
+        thread = threading.Thread(target=lambda: other.append(schema.get_connection()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(con, other[0])
+
+    def test_create_and_drop_indexes(self):
+        self.db.create_feature("featA", default_value="empty", index=True)
+        self.db.create_feature("featB", default_value=None)
+        schema = self.db.schemas[self.name]
+        self.assertEqual([ f for (_, f) in schema.get_indexes() ], [ "featA" ])
+        self.db.create_index("featB")
+        self.db.create_index("featB")
+        self.assertCountEqual([ f for (_, f) in schema.get_indexes() ], [ "featA", "featB" ])
+        self.db.drop_index("featB")
+        self.assertEqual([ f for (_, f) in schema.get_indexes() ], [ "featA" ])
+        self.db.delete_feature("featA")
+        self.assertEqual(schema.get_indexes(), [ ])
+
+    def test_csv_cache(self):
+        import shutil, tempfile
+        cachedir = tempfile.mkdtemp()
+        csvfile = util.get_random_unique_filename('test', '.csv')
+        environ = os.environ.get('GBD_CACHE')
+        os.environ['GBD_CACHE'] = cachedir
+        try:
+            with open(csvfile, 'w') as f:
+                f.write("hash,a,b\n" + "".join("h{},{},x\n".format(i, i) for i in range(50)))
+            with Database([csvfile]) as db:
+                self.assertCountEqual(db.get_features(), [ "hash", "a", "b" ])
+                self.assertEqual(len(db.query("SELECT hash FROM features")), 50)
+            cache = Schema.compile_csv(csvfile)
+            mtime = os.stat(cache).st_mtime_ns
+            with Database([csvfile]) as db:
+                self.assertEqual(len(db.query("SELECT hash FROM features")), 50)
+            self.assertEqual(Schema.compile_csv(csvfile), cache)
+            self.assertEqual(os.stat(cache).st_mtime_ns, mtime)  # reused
+            with open(csvfile, 'a') as f:
+                f.write("h50,50,y\n")
+            with Database([csvfile]) as db:
+                self.assertEqual(len(db.query("SELECT hash FROM features")), 51)
+        finally:
+            if environ is None:
+                del os.environ['GBD_CACHE']
+            else:
+                os.environ['GBD_CACHE'] = environ
+            shutil.rmtree(cachedir)
+            os.remove(csvfile)
+
+    def test_schema_cache_pruning(self):
+        import shutil, tempfile, json
+        cachedir = tempfile.mkdtemp()
+        try:
+            sources = { "old": self.file, "new": self.file, "gone": "/nonexistent/test.db" }
+            for (n, (name, path)) in enumerate(sources.items()):
+                with open(os.path.join(cachedir, name + ".json"), 'w') as f:
+                    json.dump({ "source": [ path ], "features": [ ] }, f)
+                os.utime(os.path.join(cachedir, name + ".json"), ns=(n * 10**9, n * 10**9))
+            with open(os.path.join(cachedir, "broken.json"), 'w') as f:
+                f.write("{")
+            Schema.prune_schema_cache(cachedir, maxentries=4)
+            self.assertEqual(len(os.listdir(cachedir)), 4)
+            Schema.prune_schema_cache(cachedir, maxentries=3)
+            self.assertEqual(os.listdir(cachedir), [ "new.json" ])
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_schema_cache(self):
+        import shutil, tempfile
+        cachedir = tempfile.mkdtemp()
+        environ = os.environ.get('GBD_CACHE')
+        os.environ['GBD_CACHE'] = cachedir
+        try:
+            self.db.create_feature("featA", default_value=None, datatype="int")
+            self.db.create_feature("featB", default_value="empty")
+            self.db.commit()
+            with Database([self.file]) as db:
+                expected = db.schemas[self.name].features
+                self.assertEqual(len(os.listdir(os.path.join(cachedir, "schema"))), 1)
+            with sqlite3.connect(self.file) as con:
+                self.assertEqual(Schema.features_from_database(self.name, self.file, con), expected)
+                self.assertEqual(Schema.introspect_database(self.name, con), expected)
+            with Database([self.file]) as db:
+                self.assertEqual(db.schemas[self.name].features, expected)
+                self.assertEqual(db.find("featA").datatype, "int")
+                db.create_feature("featC", default_value=None)
+            with Database([self.file]) as db:
+                self.assertIn("featC", db.get_features())
+            # recreated under the same path with the same schema_version
+            self.db.pool.close()
+            os.remove(self.file)
+            sqlite3.connect(self.file).close()
+            os.environ['GBD_CACHE'] = os.path.join(cachedir, "other")
+            with Database([self.file]) as db:
+                db.create_feature("featX", default_value=None)
+                db.create_feature("featY", default_value="empty")
+                db.create_feature("featZ", default_value=None)
+            os.environ['GBD_CACHE'] = cachedir
+            with Database([self.file]) as db:
+                self.assertCountEqual(db.get_features(), [ "hash", "featX", "featY", "featZ" ])
+        finally:
+            if environ is None:
+                del os.environ['GBD_CACHE']
+            else:
+                os.environ['GBD_CACHE'] = environ
+            shutil.rmtree(cachedir)
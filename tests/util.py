@@ -1,5 +1,17 @@
 import random
 import os
+import atexit
+import shutil
+import tempfile
+
+# keep persistent caches of test runs (schema metadata, compiled csv files, hashes) out of the user's cache directory
+# worker processes import the test modules again, they inherit the cache directory of the test run
+if not 'GBD_TEST_CACHE' in os.environ:
+    os.environ['GBD_TEST_CACHE'] = tempfile.mkdtemp(prefix="gbd-test-cache-")
+    atexit.register(shutil.rmtree, os.environ['GBD_TEST_CACHE'], ignore_errors=True)
+CACHE_DIR = os.environ['GBD_TEST_CACHE']
+os.environ['GBD_CACHE'] = CACHE_DIR
+os.environ['GBD_HASH_CACHE'] = os.path.join(CACHE_DIR, "hashes.db")
 
 def get_random_clause(max_len=10, max_vars=30):
     return ' '.join([str(random.randint(-max_vars, max_vars)) for _ in range(random.randint(0, max_len))]) + ' 0'